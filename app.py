@@ -1,5 +1,5 @@
 # Dependences
-from flask import Flask, Response, request, current_app, abort
+from flask import Flask, Response, request, current_app, abort, g
 from flask_cors import CORS
 from datetime import datetime, timedelta
 from flask_jwt import JWT, JWTError, jwt_required, current_identity, _jwt
@@ -7,29 +7,161 @@ from werkzeug.exceptions import HTTPException
 from functools import wraps, partial
 import os
 import json
+import gzip
+import time
+import concurrent.futures as cf
 
 import traceback
 #import uuid
 #import pymongo
 import glob2
-from database_core import Database
-from search_engine import SearchEngine
+from database_core import Database, EmbeddingsStore, Params, LRUCache, METRICS, SamplingProfiler, QUERY_CACHE, clean_text
+from search_engine import SearchEngine, reciprocal_rank_fusion
+from lexical_engine import BM25Engine, RerankEngine
 
-from threading import Thread
+from threading import Thread, Lock
 
 # Start APP
 app = Flask(__name__)
 CORS(app)
 SERVER_PORT = 7575
 
-# Load dataset
-EMBEDDINGS = {}
+# Ranked hash_ids per (algorithm, query), pages are served from here
+SEARCH_K = 300
+RESULTS_CACHE = LRUCache(Params.RESULTS_CACHE_SIZE, Params.RESULTS_CACHE_TTL)
+
+# Fusion runs every engine of a request concurrently
+FUSION_EXECUTOR = cf.ThreadPoolExecutor(max_workers=Params.FUSION_WORKERS)
+
+# Sampling profiler, only when enabled (PROFILE_SAMPLING=1), see /profile
+PROFILER = SamplingProfiler(interval=Params.PROFILE_INTERVAL)
+if Params.PROFILE_SAMPLING:
+    PROFILER.start()
+
+"""
+==========================================0
+    ENGINES
+==========================================0
+"""
+# Engines are built in background threads, the server answers (503 for loading engines) meanwhile
 ENGINES = {}
-for method_name in Database.list_methods():
+ENGINES_STATUS = {}
+ENGINES_LOCK = Lock()
+STATUS_LOADING, STATUS_READY, STATUS_ERROR = 'loading', 'ready', 'error'
+
+def rerank_name(method_name):
+    return '%s+%s' % (BM25Engine.NAME, method_name)
+
+def engine_params(method_name):
+    return dict(dict(use_faiss=False, index_path=Params.INDEXES_PATH), **Params.ENGINES_PARAMS.get(method_name, {}))
+
+def rerank_methods():
+    # Candidates are reranked with the exact matrix, FAISS engines have none
+    return [method_name for method_name in Database.list_methods() if not engine_params(method_name)['use_faiss']]
+
+def set_engine(name, engine=None, status=STATUS_READY):
+    with ENGINES_LOCK:
+        if engine is not None:
+            ENGINES[name] = engine
+        ENGINES_STATUS[name] = status
+
+        # Lexical candidates reranked by every vector engine, as soon as both are ready
+        for method_name in rerank_methods():
+            if ENGINES_STATUS.get(rerank_name(method_name)) != STATUS_LOADING:
+                continue
+            if STATUS_ERROR in (ENGINES_STATUS[BM25Engine.NAME], ENGINES_STATUS[method_name]):
+                ENGINES_STATUS[rerank_name(method_name)] = STATUS_ERROR
+            elif BM25Engine.NAME in ENGINES and method_name in ENGINES:
+                ENGINES[rerank_name(method_name)] = RerankEngine(ENGINES[BM25Engine.NAME], ENGINES[method_name], num_candidates=Params.RERANK_CANDIDATES)
+                ENGINES_STATUS[rerank_name(method_name)] = STATUS_READY
+
+def load_engine(name, build):
+    a0 = time.time()
+    try:
+        set_engine(name, build())
+        print('ENGINE READY', name, '%.2fs' % (time.time() - a0))
+    except Exception:
+        traceback.print_exc()
+        set_engine(name, status=STATUS_ERROR)
+
+def build_vector_engine(method_name):
+    # From the shared embeddings store when exported (see export_embeddings.py) since the last
+    # embeddings update, MongoDB otherwise
+    method = Database.get_method(method_name)
+    embeddings_version = Database.embeddings_version(method_name)
+    embeddings = EmbeddingsStore.load(method_name, embeddings_version=embeddings_version)
+    if embeddings is not None:
+        section_embeddings = {section: EmbeddingsStore.load('%s.%s' % (method_name, section), embeddings_version=embeddings_version) for section in Params.SEARCH_SECTIONS}
+        section_embeddings = {section: v for section, v in section_embeddings.items() if v is not None}
+    else:
+        embeddings = Database.list_doc_embeddings(method_name)
+        section_embeddings = Database.list_doc_embeddings_from_sections(method_name, Params.SEARCH_SECTIONS, use_translation=True)
+    return SearchEngine(method, embeddings, section_doc_embeddings=section_embeddings, **engine_params(method_name))
+
+def tokenize(text):
+    c_text = clean_text(text)
+    return c_text.split() if c_text is not None else None
+
+def build_lexical_engine():
+    # Fingerprint and tokens both come from MongoDB, a stale export would not match the tokens
+    sources_hashes = Database.list_sources_hashes()
+    return BM25Engine.load_or_create(os.path.join(Params.INDEXES_PATH, BM25Engine.NAME), sources_hashes, Database.iter_doc_tokens, tokenize)
+
+def start_loading():
+    builders = {method_name: partial(build_vector_engine, method_name) for method_name in Database.list_methods()}
+    builders[BM25Engine.NAME] = build_lexical_engine
+    ENGINES_STATUS.update({name: STATUS_LOADING for name in builders})
+    ENGINES_STATUS.update({rerank_name(method_name): STATUS_LOADING for method_name in rerank_methods()})
+
+    threads = [Thread(target=load_engine, args=(name, build), daemon=True) for name, build in builders.items()]
+    for thread in threads:
+        thread.start()
+    return threads
+
+LOADING_THREADS = start_loading()
+
+def index_documents(method_name, hash_ids):
+    """
+        Index stage of the sync pipeline, new or changed papers are searchable by the loaded
+        vector engines (and their sections) once embedded. The BM25 index is only rebuilt at start.
+    """
+    with ENGINES_LOCK:
+        engine = ENGINES.get(method_name, None)
+    if engine is None:
+        return
+
     method = Database.get_method(method_name)
+    engine.add(*EmbeddingsStore.to_matrix(method, Database.list_doc_embeddings(method_name, hash_ids)))
+    section_embeddings = Database.list_doc_embeddings_from_sections(method_name, list(engine.section_engines.keys()), hash_ids, use_translation=True)
+    for section, section_engine in engine.section_engines.items():
+        section_engine.add(*EmbeddingsStore.to_matrix(method, section_embeddings[section]))
+    RESULTS_CACHE.clear()
+
+# Sync pipeline in the server process (SYNC_IN_APP=1), from SYNC_FOLDER or Kaggle. With several server
+# workers only the one holding the sync lease syncs (see Database.sync), the engines of the others
+# get the new papers when they are loaded again
+if Params.SYNC_IN_APP:
+    SYNC_THREAD = Thread(target=Database.sync, kwargs=dict(folder_path=Params.SYNC_FOLDER, callback_index=index_documents), daemon=True)
+    SYNC_THREAD.start()
 
-    EMBEDDINGS[method_name] = Database.list_doc_embeddings(method_name)
-    ENGINES[method_name] = SearchEngine(method, EMBEDDINGS[method_name], use_faiss=False) 
+METRICS.describe('coronagle_engine_ready', 'Whether every engine is loaded (1) or not (0)')
+METRICS.gauge('coronagle_engine_ready', lambda: {(('algorithm', name), ): float(status == STATUS_READY) for name, status in list(ENGINES_STATUS.items())})
+METRICS.describe('coronagle_cache_hits_total', 'Hits of the query vector, results and documents caches')
+METRICS.describe('coronagle_cache_misses_total', 'Misses of the query vector, results and documents caches')
+CACHES = [('query', QUERY_CACHE), ('results', RESULTS_CACHE), ('documents', Database.DOCUMENTS_CACHE)]
+METRICS.counter('coronagle_cache_hits_total', lambda: {(('cache', name), ): cache.stats()['hits'] for name, cache in CACHES})
+METRICS.counter('coronagle_cache_misses_total', lambda: {(('cache', name), ): cache.stats()['misses'] for name, cache in CACHES})
+
+def get_engine(algo_query):
+    """
+        400 for unknown algorithms, 503 (retry later) while the engine is loading or failed to load
+    """
+    if algo_query not in ENGINES_STATUS:
+        abort(400)
+    if ENGINES_STATUS[algo_query] != STATUS_READY:
+        abort(Response(json.dumps({'algorithm': algo_query, 'status': ENGINES_STATUS[algo_query]}), status=503,
+            headers={'Retry-After': '5'}, mimetype='application/json'))
+    return ENGINES[algo_query]
 """
 ==========================================0
     USERS
@@ -75,33 +207,180 @@ def group_decorator(group=None, groups=[]):
     APP
 ==========================================0
 """
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def stop_timer(response):
+    # Registered before compress, so it runs after it (after_request runs in reverse order)
+    if 'request_start' in g:
+        METRICS.observe('coronagle_request_seconds', time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+@app.after_request
+def compress(response):
+    # Result pages are large JSON documents, gzip them for clients that accept it
+    if not Params.GZIP_RESPONSES or response.direct_passthrough or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if 'gzip' not in request.headers.get('Accept-Encoding', '').lower():
+        return response
+
+    data = response.get_data()
+    if len(data) < Params.GZIP_MIN_SIZE:
+        return response
+    with METRICS.timer('coronagle_stage_seconds', stage='gzip'):
+        response.set_data(gzip.compress(data, compresslevel=Params.GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def json_response(output):
+    with METRICS.timer('coronagle_stage_seconds', stage='json'):
+        return Response(json.dumps(output), mimetype='application/json')
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profile', methods=["GET"])
+def profile():
+    if not Params.PROFILE_SAMPLING:
+        abort(404)
+    output = PROFILER.render(top=request.args.get('top', None, type=int))
+    if request.args.get('reset', '0') == '1':
+        PROFILER.reset()
+    return Response(output, mimetype='text/plain')
+
 @app.route('/init', methods=["GET"])
 def init():
     return {
-        'algorithms': Database.list_methods()
+        'algorithms': list(ENGINES_STATUS.keys()),
+        'status': dict(ENGINES_STATUS),
+        'sections': Params.SEARCH_SECTIONS
     }
 
+@app.route('/ready', methods=["GET"])
+def ready():
+    status = dict(ENGINES_STATUS)
+    is_ready = all(v == STATUS_READY for v in status.values())
+    return Response(json.dumps({'ready': is_ready, 'status': status}), status=200 if is_ready else 503, mimetype='application/json')
+
+def get_ranked_hash_ids(algo_query, search_query, section=None, rank=None):
+    """
+        Cached per (algo_query, section, query), rank() computes the ranking instead of the
+        engine of algo_query, e.g. fusion with algo_query = ('fusion', algorithms)
+    """
+    hash_ids = RESULTS_CACHE.get((algo_query, section, search_query))
+    if hash_ids is None:
+        if rank is not None:
+            hash_ids = rank()
+        else:
+            engine = get_engine(algo_query)
+            # Vector engines include the query vector (clean + inference stages) here
+            with METRICS.timer('coronagle_stage_seconds', stage='search', algorithm=algo_query):
+                hash_ids = engine.get_similar_docs_than(search_query, k=SEARCH_K, section=section)
+        RESULTS_CACHE.put((algo_query, section, search_query), hash_ids)
+    return hash_ids
+
 @app.route('/search', methods=["POST"])
 def search():
     data = json.loads(request.data)
     search_query = data['query']
     algo_query = data['algorithm']
-    hash_ids = ENGINES[algo_query].get_similar_docs_than(search_query, k=300)
-    documents = Database.list_raw_documents(hash_ids=hash_ids)
+    offset = max(0, int(data.get('offset', 0)))
+    limit = data.get('limit', None)
+    section = data.get('section', None)
+    if section is not None and section not in get_engine(algo_query).section_engines:
+        abort(400)
+
+    ranked_hash_ids = get_ranked_hash_ids(algo_query, search_query, section)
+    return json_response(render_page(ranked_hash_ids, offset, limit))
+
+def render_page(ranked_hash_ids, offset, limit):
+    hash_ids = ranked_hash_ids[offset:] if limit is None else ranked_hash_ids[offset:offset + max(0, int(limit))]
+    positions = {hash_id: i for i, hash_id in enumerate(hash_ids)}
+
+    # Title, abstract and the precomputed snippet only, already in rank order
+    with METRICS.timer('coronagle_stage_seconds', stage='fetch'):
+        documents = Database.list_search_results(hash_ids)
 
     documents_return = []
-    for i, doc in enumerate(documents):
+    for doc in documents:
+        sections = doc.get('raw', {}).get('sections', {})
         documents_return.append({
-            'rank': i,
+            'rank': offset + positions[doc['hash_id']],
             'reference_id': doc['hash_id'],
             'title': doc['title'],
-            'abstract': doc['raw']['sections']['abstract'] if 'abstract' in doc['raw']['sections'] else "-",
-            'body': "\n".join([v for k, v in doc['raw']['sections'].items() if k != "abstract"])
+            'abstract': sections['abstract'] if 'abstract' in sections else "-",
+            'body': doc.get('snippet', "-")
         })
 
     return {
-        'documents': documents_return
+        'documents': documents_return,
+        'total': len(ranked_hash_ids),
+        'offset': offset,
+        'limit': limit
     }
 
+def timed_search(algo_query, search_query):
+    # Shares the cached rankings of /search
+    a0 = time.perf_counter()
+    hash_ids = get_ranked_hash_ids(algo_query, search_query)
+    return hash_ids, time.perf_counter() - a0
+
+@app.route('/search_fusion', methods=["POST"])
+def search_fusion():
+    data = json.loads(request.data)
+    search_query = data['query']
+    algo_queries = data.get('algorithms', Database.list_methods())
+    offset = max(0, int(data.get('offset', 0)))
+    limit = data.get('limit', None)
+    if len(algo_queries) == 0:
+        abort(400)
+    for algo_query in algo_queries:
+        get_engine(algo_query)
+
+    # Engines run in parallel, the request takes as long as the slowest one
+    a0 = time.perf_counter()
+    timings = {}
+    def rank():
+        futures = {algo_query: FUSION_EXECUTOR.submit(timed_search, algo_query, search_query) for algo_query in algo_queries}
+        rankings = []
+        for algo_query, future in futures.items():
+            hash_ids, elapsed = future.result()
+            rankings.append(hash_ids)
+            timings[algo_query] = elapsed * 1000
+        return reciprocal_rank_fusion(rankings, k=Params.FUSION_RRF_K)[:SEARCH_K]
+
+    # Pages of the same query are served from the cached fused ranking (only 'total' in the timings)
+    ranked_hash_ids = get_ranked_hash_ids(('fusion', tuple(algo_queries)), search_query, rank=rank)
+    timings['total'] = (time.perf_counter() - a0) * 1000
+
+    output = render_page(ranked_hash_ids, offset, limit)
+    output['timings_ms'] = timings
+    return json_response(output)
+
+@app.route('/search_batch', methods=["POST"])
+def search_batch():
+    data = json.loads(request.data)
+    search_queries = data['queries']
+    algo_query = data['algorithm']
+    k = int(data.get('k', 300))
+    section = data.get('section', None)
+    engine = get_engine(algo_query)
+    if section is not None and section not in engine.section_engines:
+        abort(400)
+    with METRICS.timer('coronagle_stage_seconds', stage='search_batch', algorithm=algo_query):
+        results = engine.search_batch(search_queries, k=k, section=section)
+
+    return json_response({
+        'results': [{
+            'query': search_query,
+            'reference_ids': hash_ids
+        } for search_query, hash_ids in zip(search_queries, results)]
+    })
+
 if __name__ == '__main__':
     app.run(port=SERVER_PORT)
\ No newline at end of file
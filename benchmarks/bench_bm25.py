@@ -0,0 +1,82 @@
+"""
+BM25 search benchmark and correctness check: exhaustive scoring of every posting
+against the block-max MaxScore search_tokens, on a Zipf-distributed synthetic corpus.
+Every query asserts that MaxScore returns the exhaustive top-k scores (ties at the
+threshold may pick other documents with the same score).
+
+    python bench_bm25.py --num-docs 100000 --num-queries 500
+    python bench_bm25.py --num-docs 5000 --num-queries 2000 --k 1 10 100 1000    # correctness sweep
+"""
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+import numpy as np
+
+from lexical_engine import BM25Engine
+
+def create_doc_tokens(rng, num_docs, vocabulary_size, mean_length):
+    probabilities = 1 / np.arange(1, vocabulary_size + 1)
+    probabilities /= probabilities.sum()
+    lengths = rng.poisson(mean_length, size=num_docs) + 1
+    words = rng.choice(vocabulary_size, size=lengths.sum(), p=probabilities)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return [{'hash_id': '%040x' % i, 'tokens': ['w%d' % w for w in words[offsets[i]:offsets[i + 1]]]} for i in range(num_docs)]
+
+def exhaustive_scores(engine, tokens):
+    scores = np.zeros(len(engine.doc_hash_id), dtype=np.float32)
+    for term in {engine.vocabulary[token] for token in tokens if token in engine.vocabulary}:
+        start, end = engine.term_offsets[term], engine.term_offsets[term + 1]
+        scores[engine.postings_docs[start:end]] += engine.postings_impacts[start:end]
+    return scores
+
+def exhaustive_search(engine, tokens, k):
+    scores = exhaustive_scores(engine, tokens)
+    top = np.argsort(-scores, kind='stable')[:k]
+    return engine.doc_hash_id[top[scores[top] > 0]].tolist()
+
+def check(engine, tokens, k):
+    scores = exhaustive_scores(engine, tokens)
+    positions = {hash_id: i for i, hash_id in enumerate(engine.doc_hash_id.tolist())}
+    expected = np.sort(scores[scores > 0])[::-1][:k]
+    found = engine.search_tokens(tokens, k=k)
+    assert len(found) == len(set(found)), tokens
+    found_scores = scores[[positions[hash_id] for hash_id in found]]
+    assert len(found_scores) == len(expected) and np.allclose(found_scores, expected, rtol=1e-5, atol=1e-5), (tokens, k)
+
+def timeit(func, queries):
+    times = []
+    for tokens in queries:
+        a0 = time.perf_counter()
+        func(tokens)
+        times.append(time.perf_counter() - a0)
+    return np.median(times) * 1000, np.percentile(times, 99) * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=50000)
+    parser.add_argument('--vocabulary-size', type=int, default=50000)
+    parser.add_argument('--mean-length', type=int, default=150)
+    parser.add_argument('--num-queries', type=int, default=500)
+    parser.add_argument('--k', type=int, nargs='+', default=[10, 300])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    a0 = time.perf_counter()
+    engine = BM25Engine(create_doc_tokens(rng, args.num_docs, args.vocabulary_size, args.mean_length), tokenize=None)
+    print('%d documents, %d terms, %d postings, built in %.2f s' % (len(engine.doc_hash_id), len(engine.vocabulary), len(engine.postings_docs), time.perf_counter() - a0))
+
+    # 1 to 6 words, common and rare ones, sometimes repeated or out of the vocabulary
+    queries = []
+    for _ in range(args.num_queries):
+        words = rng.zipf(1.3, size=rng.integers(1, 7)) - 1
+        queries.append(['w%d' % w for w in words] + (['unknown'] if rng.random() < 0.1 else []))
+
+    print('%6s %22s %22s %8s' % ('k', 'exhaustive p50/p99 ms', 'maxscore p50/p99 ms', 'speedup'))
+    for k in args.k:
+        for tokens in queries:
+            check(engine, tokens, k)
+        exhaustive_ms = timeit(lambda tokens: exhaustive_search(engine, tokens, k), queries)
+        maxscore_ms = timeit(lambda tokens: engine.search_tokens(tokens, k=k), queries)
+        print('%6d %12.2f / %7.2f %12.2f / %7.2f %7.1fx' % (k, exhaustive_ms[0], exhaustive_ms[1], maxscore_ms[0], maxscore_ms[1], exhaustive_ms[0] / maxscore_ms[0]))
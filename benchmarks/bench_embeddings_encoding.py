@@ -0,0 +1,78 @@
+"""
+list_doc_embeddings with pickled section vectors (format before the binary encoding)
+against the binary float32 / float16 encodings, after Database.migrate_embeddings.
+
+    python bench_embeddings_encoding.py --in-process --num-docs 20000
+    python bench_embeddings_encoding.py --num-docs 50000 --num-dimensions 2048
+
+The documents collection of the benchmark database (MONGO_DB_NAME, coronagle_bench
+by default) is dropped.
+"""
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import pickle
+import time
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=20000)
+    parser.add_argument('--num-sections', type=int, default=6)
+    parser.add_argument('--num-dimensions', type=int, default=200)
+    parser.add_argument('--in-process', action='store_true', help='mongomock instead of a mongod')
+    parser.add_argument('--db-name', default='coronagle_bench')
+    return parser.parse_args()
+
+def timed(func, *args, **kwargs):
+    a0 = time.perf_counter()
+    output = func(*args, **kwargs)
+    return output, time.perf_counter() - a0
+
+def insert_pickled_documents(collection, method_name, num_docs, num_sections, num_dimensions):
+    from bson.binary import Binary
+    rng = np.random.default_rng(0)
+    for i in range(0, num_docs, 1000):
+        documents = []
+        for j in range(i, min(i + 1000, num_docs)):
+            sections_vector = {'section%d' % k: {
+                'vector': Binary(pickle.dumps(rng.standard_normal(num_dimensions).astype(np.float32), protocol=2)),
+                'num_elements': int(rng.integers(10, 500))
+            } for k in range(num_sections)}
+            documents.append({'hash_id': '%040x' % j, 'sections_embeddings': {method_name: sections_vector}, 'sections_translation': {}})
+        collection.insert_many(documents)
+
+def storage_bytes(collection, method_name):
+    return sum(len(section['vector']) for doc in collection.find({}, {f'sections_embeddings.{method_name}': 1})
+        for section in doc['sections_embeddings'][method_name].values())
+
+if __name__ == '__main__':
+    args = parse_args()
+    os.environ['MONGO_DB_NAME'] = args.db_name
+    if args.in_process:
+        os.environ['MONGO_IN_PROCESS'] = '1'
+
+    from database_core import Database, Connection, SpacyEmbeddings
+    from synthetic_corpus import create_synthetic_method
+
+    Database.METHODS.clear()
+    method = create_synthetic_method(SpacyEmbeddings, 'SyntheticSpacy', args.num_dimensions)
+    Database.register_method(method)
+
+    Connection.DB.documents.drop()
+    insert_pickled_documents(Connection.DB.documents, method.NAME, args.num_docs, args.num_sections, args.num_dimensions)
+    print('%d documents, %d sections, %d dimensions' % (args.num_docs, args.num_sections, args.num_dimensions))
+
+    reference, elapsed = timed(Database.list_doc_embeddings, method.NAME)
+    print('%-32s %8.2f s  %10d bytes' % ('pickle', elapsed, storage_bytes(Connection.DB.documents, method.NAME)))
+
+    for dtype, tolerance in [('float32', 1e-6), ('float16', 1e-2)]:
+        _, elapsed = timed(Database.migrate_embeddings, [method.NAME], dtype=dtype)
+        print('%-32s %8.2f s' % ('migrate to %s' % dtype, elapsed))
+
+        embeddings, elapsed = timed(Database.list_doc_embeddings, method.NAME)
+        print('%-32s %8.2f s  %10d bytes' % (dtype, elapsed, storage_bytes(Connection.DB.documents, method.NAME)))
+
+        error = max(np.abs(a['vector'] - b['vector']).max() for a, b in zip(reference, embeddings))
+        assert error < tolerance, error
+    Connection.DB.documents.drop()
@@ -0,0 +1,54 @@
+"""
+Exact (non FAISS) search benchmark: legacy np.stack + cdist + argsort path
+against the precomputed float32 matrix + matmul + argpartition path.
+
+    python bench_exact_search.py --sizes 50000 200000 1000000 --dims 200
+"""
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+import numpy as np
+from scipy.spatial import distance
+
+from search_engine import SearchEngine
+
+def legacy_search(vectors, hash_ids, query, k):
+    distances = distance.cdist(np.expand_dims(query, axis=0), np.stack(vectors, axis=0), 'cosine')
+    indices = distances.argsort(axis=-1)[:, :k]
+    return [hash_ids[idx] for idx in indices[0]]
+
+def timeit(func, repeat):
+    times = []
+    for _ in range(repeat):
+        a0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - a0)
+    return np.median(times) * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50000, 200000, 1000000])
+    parser.add_argument('--dims', type=int, default=200)
+    parser.add_argument('--k', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('%10s %14s %14s %14s %8s' % ('num_docs', 'build (ms)', 'legacy (ms)', 'matrix (ms)', 'speedup'))
+    for size in args.sizes:
+        # Same layout list_doc_embeddings returns: float64 vectors, one per document
+        doc_embeddings = [{'vector': v, 'hash_id': str(i)} for i, v in enumerate(rng.standard_normal((size, args.dims)))]
+        vectors = [doc['vector'] for doc in doc_embeddings]
+        hash_ids = [doc['hash_id'] for doc in doc_embeddings]
+        query = rng.standard_normal(args.dims)
+
+        a0 = time.perf_counter()
+        engine = SearchEngine(None, doc_embeddings, use_faiss=False, similarity_metric='cosine')
+        build_ms = (time.perf_counter() - a0) * 1000
+
+        assert engine.search_vectors(np.expand_dims(query, axis=0), k=10)[0] == legacy_search(vectors, hash_ids, query, 10)
+        legacy_ms = timeit(lambda: legacy_search(vectors, hash_ids, query, args.k), args.repeat)
+        matrix_ms = timeit(lambda: engine.search_vectors(np.expand_dims(query, axis=0), k=args.k), args.repeat)
+        print('%10d %14.2f %14.2f %14.2f %7.1fx' % (size, build_ms, legacy_ms, matrix_ms, legacy_ms / matrix_ms))
+        del doc_embeddings, vectors, hash_ids, engine
@@ -0,0 +1,74 @@
+"""
+FAISS index spec sweep: recall@k against the exact search, QPS and bytes per
+vector for every index spec accepted by SearchEngine.
+
+    python bench_faiss_indexes.py --num-docs 200000 --dims 1024 --nprobe 8 16 32
+"""
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import time
+import numpy as np
+import faiss
+
+from search_engine import SearchEngine
+
+SPECS = [
+    'IVF{num_centroids},Flat',
+    'IVF{num_centroids},SQ8',
+    'IVF{num_centroids},PQ{pq_m}',
+    'OPQ{pq_m},IVF{num_centroids},PQ{pq_m}',
+    'HNSW32',
+    'HNSW32,SQ8',
+]
+
+def synthetic_embeddings(num_docs, dims, num_clusters=256, seed=0):
+    # Clustered data, recall on isotropic gaussian noise says nothing about real embeddings
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dims))
+    labels = rng.integers(0, num_clusters, size=num_docs)
+    return centers[labels] + 0.5 * rng.standard_normal((num_docs, dims))
+
+def recall_at_k(results, ground_truth):
+    return np.mean([len(set(r) & set(g)) / len(g) for r, g in zip(results, ground_truth)])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=200000)
+    parser.add_argument('--dims', type=int, default=1024)
+    parser.add_argument('--num-queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--pq-m', type=int, default=64)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--metric', default='cosine')
+    args = parser.parse_args()
+
+    vectors = synthetic_embeddings(args.num_docs + args.num_queries, args.dims)
+    doc_embeddings = [{'vector': v, 'hash_id': str(i)} for i, v in enumerate(vectors[:args.num_docs])]
+    queries = vectors[args.num_docs:]
+
+    exact = SearchEngine(None, doc_embeddings, use_faiss=False, similarity_metric=args.metric)
+    a0 = time.perf_counter()
+    ground_truth = exact.search_vectors(queries, k=args.k)
+    exact_qps = len(queries) / (time.perf_counter() - a0)
+    print('%-40s %-14s %10s %10s %10s %10s' % ('spec', 'params', 'build (s)', 'recall@%d' % args.k, 'QPS', 'bytes/vec'))
+    print('%-40s %-14s %10s %10.4f %10.1f %10d' % ('exact', '-', '-', 1.0, exact_qps, 4 * args.dims))
+    del exact
+
+    for spec in SPECS:
+        spec = spec.replace('{pq_m}', str(args.pq_m))
+        a0 = time.perf_counter()
+        engine = SearchEngine(None, doc_embeddings, use_faiss=True, similarity_metric=args.metric, index_spec=spec)
+        build_s = time.perf_counter() - a0
+        bytes_per_vector = len(faiss.serialize_index(engine.faiss_index)) / engine.faiss_index.ntotal
+
+        sweep = [('efSearch', v) for v in args.ef_search] if spec.startswith('HNSW') else [('nprobe', v) for v in args.nprobe]
+        for name, value in sweep:
+            engine.search_params = {name: value}
+            engine.set_search_params()
+            a0 = time.perf_counter()
+            results = engine.search_vectors(queries, k=args.k)
+            qps = len(queries) / (time.perf_counter() - a0)
+            print('%-40s %-14s %10.1f %10.4f %10.1f %10.1f' % (spec.format(num_centroids=engine.num_centroids), '%s=%d' % (name, value), build_s, recall_at_k(results, ground_truth), qps, bytes_per_vector))
+        del engine
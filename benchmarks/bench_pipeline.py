@@ -0,0 +1,108 @@
+"""
+End to end benchmark on a synthetic CORD-19-like corpus: ingest (scan_folder),
+embedding (update_mean_vectors), embedding load (list_doc_embeddings), engine
+build and /search latency percentiles, at several corpus sizes.
+
+    python bench_pipeline.py --in-process --sizes 1000 5000 20000
+    python bench_pipeline.py --sizes 1000 5000     # local mongod from the MONGO_* env, bench database
+
+Everything runs offline. The documents collection of the benchmark database
+(MONGO_DB_NAME, coronagle_bench by default) is dropped at every size.
+"""
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import argparse
+import tempfile
+import shutil
+import time
+import json
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--in-process', action='store_true', help='mongomock instead of a mongod')
+    parser.add_argument('--db-name', default='coronagle_bench')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--spacy-dims', type=int, default=200)
+    parser.add_argument('--flair-dims', type=int, default=1024)
+    return parser.parse_args()
+
+def percentiles(times):
+    times = np.array(times) * 1000
+    return 'p50 %8.2f  p95 %8.2f  p99 %8.2f ms' % tuple(np.percentile(times, [50, 95, 99]))
+
+def wait_ready(client):
+    # Engines load in background threads, /ready answers 503 until all of them are built
+    while client.get('/ready').status_code != 200:
+        time.sleep(0.05)
+
+def timed(func, *args, **kwargs):
+    a0 = time.perf_counter()
+    output = func(*args, **kwargs)
+    return output, time.perf_counter() - a0
+
+if __name__ == '__main__':
+    args = parse_args()
+    work_folder = tempfile.mkdtemp(prefix='coronagle_bench_')
+
+    # Before importing database_core, Params reads them at import time
+    os.environ['MONGO_DB_NAME'] = args.db_name
+    os.environ['INDEXES_PATH'] = os.path.join(work_folder, 'indexes')
+    if args.in_process:
+        os.environ['MONGO_IN_PROCESS'] = '1'
+
+    from database_core import Database, Connection, SpacyEmbeddings, FlairEmbeddings
+    from search_engine import SearchEngine
+    from synthetic_corpus import write_corpus, create_synthetic_method
+
+    # Real models are replaced by synthetic ones with the same aggregation and dimensions
+    Database.METHODS.clear()
+    Database.register_method(create_synthetic_method(SpacyEmbeddings, 'SyntheticSpacy', args.spacy_dims))
+    Database.register_method(create_synthetic_method(FlairEmbeddings, 'SyntheticFlair', args.flair_dims))
+
+    try:
+        for size in args.sizes:
+            print('=' * 80)
+            print('%d documents' % size)
+            Connection.DB.documents.drop()
+            corpus_folder = os.path.join(work_folder, 'corpus_%d' % size)
+            vocabulary = write_corpus(corpus_folder, size)
+
+            _, elapsed = timed(Database.scan_folder, corpus_folder)
+            print('%-40s %10.2f s  (%.0f docs/s)' % ('ingest (scan_folder)', elapsed, size / elapsed))
+
+            for method_name in Database.list_methods():
+                _, elapsed = timed(Database.update_mean_vectors, method_name, force=True)
+                print('%-40s %10.2f s  (%.0f docs/s)' % ('embed %s' % method_name, elapsed, size / elapsed))
+
+                embeddings, elapsed = timed(Database.list_doc_embeddings, method_name)
+                print('%-40s %10.2f s' % ('load %s' % method_name, elapsed))
+
+                _, elapsed = timed(SearchEngine, Database.get_method(method_name), embeddings)
+                print('%-40s %10.2f s' % ('build %s' % method_name, elapsed))
+                del embeddings
+
+            # Full app start, every engine (vector, sections, lexical) from the database
+            sys.modules.pop('app', None)
+            app_module, elapsed = timed(__import__, 'app')
+            print('%-40s %10.2f s' % ('app start', elapsed))
+            client = app_module.app.test_client()
+            _, elapsed = timed(wait_ready, client)
+            print('%-40s %10.2f s' % ('app ready', elapsed))
+
+            rng = np.random.default_rng(size)
+            queries = [' '.join(rng.choice(vocabulary[:2000], size=rng.integers(1, 5))) for _ in range(args.num_queries)]
+            for algorithm in client.get('/init').get_json()['algorithms']:
+                for page in [None, 10]:
+                    app_module.RESULTS_CACHE.clear()
+                    times = []
+                    for query in queries:
+                        data = {'query': query, 'algorithm': algorithm}
+                        if page is not None:
+                            data['limit'] = page
+                        _, elapsed = timed(client.post, '/search', data=json.dumps(data))
+                        times.append(elapsed)
+                    print('%-40s %s' % ('/search %s%s' % (algorithm, '' if page is None else ' limit=%d' % page), percentiles(times)))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
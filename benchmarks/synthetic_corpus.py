@@ -0,0 +1,103 @@
+"""
+Synthetic CORD-19-like corpus: JSON files in the shape read by
+Database.parse_document_json and embedding methods with the dimensions of the
+real ones, so the whole pipeline can be benchmarked offline.
+"""
+import os
+import json
+import zlib
+import numpy as np
+
+SECTIONS = ['Introduction', 'Methods', 'Results', 'Discussion', 'Conclusions']
+SYLLABLES = ['co', 'ro', 'na', 'vi', 'rus', 'ace', 'pro', 'te', 'in', 'gen', 'cell', 'sar', 'mer', 'ly', 'sis', 'im', 'mu', 'no', 'dra', 'zol']
+
+def create_vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES, size=rng.integers(2, 5))))
+    return np.array(sorted(words))
+
+def create_text(rng, vocabulary, probabilities, num_words):
+    words = rng.choice(vocabulary, size=num_words, p=probabilities)
+    # Sentences of ~15 words, clean_text drops the punctuation anyway
+    return ' '.join(w + ('.' if i % 15 == 14 else '') for i, w in enumerate(words))
+
+def create_document(rng, vocabulary, probabilities, paper_id):
+    body_text = []
+    for section in SECTIONS:
+        for _ in range(rng.integers(1, 4)):
+            text = create_text(rng, vocabulary, probabilities, int(rng.integers(60, 250)))
+            body_text.append({
+                'text': text,
+                'section': section,
+                'cite_spans': [{'start': 0, 'end': 4, 'ref_id': 'BIBREF0'}]
+            })
+
+    return {
+        'paper_id': paper_id,
+        'metadata': {
+            'title': create_text(rng, vocabulary, probabilities, int(rng.integers(6, 15))),
+            'authors': [{'first': 'A', 'middle': [], 'last': 'Author%d' % i, 'suffix': '', 'affiliation': {}, 'email': ''} for i in range(rng.integers(1, 6))]
+        },
+        'abstract': [{
+            'text': create_text(rng, vocabulary, probabilities, int(rng.integers(100, 250))),
+            'cite_spans': [],
+            'ref_spans': [],
+            'section': 'Abstract'
+        }],
+        'body_text': body_text,
+        'bib_entries': {'BIBREF0': {'ref_id': 'b0', 'title': 'Reference', 'authors': [], 'year': 2020, 'venue': '', 'volume': '', 'issn': '', 'pages': '', 'other_ids': {}}},
+        'ref_entries': {},
+        'back_matter': []
+    }
+
+def write_corpus(folder, num_docs, vocabulary_size=20000, seed=0):
+    """
+        Writes folder/synthetic/pdf_json/<paper_id>.json (scan_folder reads one level of subfolders)
+        and returns the vocabulary, useful to build queries
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = create_vocabulary(rng, vocabulary_size)
+    probabilities = 1 / np.arange(1, vocabulary_size + 1) ** 1.1
+    probabilities /= probabilities.sum()
+
+    json_folder = os.path.join(folder, 'synthetic', 'pdf_json')
+    os.makedirs(json_folder, exist_ok=True)
+    for i in range(num_docs):
+        paper_id = '%040x' % (seed * 10**9 + i)
+        with open(os.path.join(json_folder, paper_id + '.json'), 'w') as json_file:
+            json.dump(create_document(rng, vocabulary, probabilities, paper_id), json_file)
+    return vocabulary
+
+def text_vector(text, num_dimensions):
+    # Deterministic per text, identical queries get identical vectors
+    return np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(num_dimensions).astype(np.float32)
+
+def create_synthetic_method(base_class, name, num_dimensions):
+    """
+        base_class: a registered method (e.g. SpacyEmbeddings), its aggregation logic is kept and
+        the model is replaced by deterministic random vectors of num_dimensions
+    """
+    class SyntheticEmbeddings(base_class):
+        NAME = name
+        NUM_DIMENSIONS = num_dimensions
+        TYPE_THREADING = None
+
+        @classmethod
+        def init(cls):
+            pass
+
+        @classmethod
+        def compute_mean_vector(cls, raw_or_clean_doc):
+            return {k: {'vector': text_vector(v_text, cls.NUM_DIMENSIONS), 'num_elements': len(v_text.split())}
+                for k, v_text in raw_or_clean_doc['sections'].items() if v_text}
+
+        @classmethod
+        def compute_mean_vector_from_text(cls, text):
+            return text_vector(text, cls.NUM_DIMENSIONS)
+
+        @classmethod
+        def compute_mean_vectors_from_texts(cls, texts):
+            return [text_vector(text, cls.NUM_DIMENSIONS) for text in texts]
+
+    return SyntheticEmbeddings
@@ -1,5 +1,9 @@
 from .params import *
 from .utils import *
+from .cache import *
+from .metrics import *
+from .pipeline import *
 from .connection import *
 from .database import *
-from .methods import *
\ No newline at end of file
+from .methods import *
+from .store import *
\ No newline at end of file
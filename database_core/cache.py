@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class LRUCache:
+    """
+        Bounded, thread-safe LRU cache with an optional time to live (seconds)
+        max_size bounds the number of entries (None: unbounded), max_bytes the sum of sizeof(value)
+    """
+    def __init__(self, max_size, ttl=None, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.num_bytes = 0
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key, None)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self.pop(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def pop(self, key):
+        # Lock already held
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry[2]
+
+    def put(self, key, value):
+        if self.max_size is not None and self.max_size <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.pop(key)
+            self.data[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None, size)
+            self.num_bytes += size
+            while (self.max_size is not None and len(self.data) > self.max_size) or (self.max_bytes is not None and self.num_bytes > self.max_bytes):
+                self.pop(next(iter(self.data)))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.pop(key)
+
+    def invalidate_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'max_size': self.max_size,
+                'bytes': self.num_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -5,9 +5,39 @@ from . import Params
 class Connection:
 	CLIENT = None
 	DB = None
-try:
-    Connection.CLIENT = MongoClient(Params.DB_URL, document_class=OrderedDict)
-    Connection.DB = Connection.CLIENT[Params.DB_NAME]
-    Connection.CLIENT.server_info()
-except Exception as e:
-    raise e
\ No newline at end of file
+
+if Params.DB_IN_PROCESS:
+	# In-process stand-in (benchmarks, offline runs), mongomock has no sessions / transactions
+	import mongomock
+
+	class InProcessSession:
+		def __enter__(self):
+			return self
+
+		def __exit__(self, *args):
+			return False
+
+		def start_transaction(self, *args, **kwargs):
+			return self
+
+	class InProcessClient(mongomock.MongoClient):
+		def start_session(self, *args, **kwargs):
+			return InProcessSession()
+
+	Connection.CLIENT = InProcessClient(document_class=OrderedDict)
+	Connection.DB = Connection.CLIENT[Params.DB_NAME]
+
+else:
+	try:
+		Connection.CLIENT = MongoClient(Params.DB_URL, document_class=OrderedDict)
+		Connection.DB = Connection.CLIENT[Params.DB_NAME]
+		Connection.CLIENT.server_info()
+	except Exception as e:
+		raise e
+
+# Every lookup, $in and shard range goes through hash_id, unique so concurrent upserts cannot duplicate a paper
+# (the index of older databases is not unique, it is replaced)
+hash_id_index = Connection.DB.documents.index_information().get('hash_id_1', None)
+if hash_id_index is not None and not hash_id_index.get('unique', False):
+	Connection.DB.documents.drop_index('hash_id_1')
+Connection.DB.documents.create_index('hash_id', unique=True)
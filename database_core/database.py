@@ -1,6 +1,4 @@
-from threading import Thread
 from collections import defaultdict, OrderedDict
-import schedule
 import time
 import os
 import glob
@@ -10,11 +8,34 @@ from tqdm import tqdm
 import concurrent.futures as cf
 from functools import partial
 import pickle
+import struct
+import numpy as np
 from bson.binary import Binary
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError
 import datetime
+import hashlib
+import itertools
+import contextlib
+import traceback
+import socket
+import uuid
+from threading import Thread, Event, Lock
+
+# Faster JSON parser for ingestion (requirements), json still works but parses several times slower
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    print('WARNING: orjson is not installed, papers are parsed with json')
+    json_loads = json.loads
 
 from . import Params
 from . import Connection
+from . import clean_text
+from . import METRICS
+from . import LRUCache
+from .pipeline import Stage, Pipeline
 #from section_translator import SectionTranslator
 
 class Database:
@@ -42,11 +63,20 @@ class Database:
 
     def get_cache(name):
         data = Database.CACHE.get(name, None)
-        if data['valid'] <= datetime.datetime.now():
+        if data is not None and data['valid'] > datetime.datetime.now():
             return data['data']
         else:
             return None
 
+    def document_size(doc):
+        # Estimated in memory size of a cached search result
+        sections = doc.get('raw', {}).get('sections', {})
+        return 512 + sum(len(v) for v in [doc['hash_id'], doc.get('title') or '', doc.get('snippet') or ''] + list(sections.values()))
+
+    # Search result fields by hash_id, invalidated by every update of a document in this process
+    # and expired after Params.DOCUMENTS_CACHE_TTL for the updates made by other processes
+    DOCUMENTS_CACHE = LRUCache(None, Params.DOCUMENTS_CACHE_TTL, max_bytes=Params.DOCUMENTS_CACHE_BYTES, sizeof=document_size)
+
     """
     ==============================================================================
         METHODS HOOK
@@ -62,7 +92,8 @@ class Database:
         assert('.' not in name and '$' not in name)
         Database.METHODS[name] = {
             'class': class_method,
-            'init': False
+            'init': False,
+            'lock': Lock()
         }
 
     @staticmethod
@@ -70,9 +101,12 @@ class Database:
         assert('.' not in name and '$' not in name)
         class_dict = Database.METHODS[name]
         method_obj = class_dict['class']
+        # Loaded once, engines, the sync pipeline and requests can ask for it concurrently
         if not class_dict['init']:
-            method_obj.init()
-            class_dict['init'] = True
+            with class_dict['lock']:
+                if not class_dict['init']:
+                    method_obj.init()
+                    class_dict['init'] = True
         return method_obj
 
     @staticmethod
@@ -106,6 +140,14 @@ class Database:
                 'ref_entries': raw_document['ref_entries']
             },
             'sections_order': raw_document['sections_order'],
+            'snippet': Database.compute_snippet(raw_document['sections']),
+            # Content hash of the sections per source ('raw' / 'clean'), see update_mean_vectors
+            'sources_hash': {
+                'raw': Database.compute_sources_hash(raw_document['sections'])
+            },
+            'embeddings_hash': {
+                # method: sources_hash of the embedded contents
+            },
             'sections_embeddings': {
                 # algorithm:
                 #   word2vec: 
@@ -126,6 +168,25 @@ class Database:
 
         return document
 
+    @staticmethod
+    def compute_sources_hash(sections):
+        sha = hashlib.sha1()
+        for k in sorted(sections.keys()):
+            sha.update(('%s\0%s\0' % (k, sections[k] or '')).encode('utf-8'))
+        return sha.hexdigest()
+
+    @staticmethod
+    def compute_snippet(sections, length=None):
+        """
+            Short preview of the body (abstract excluded) for search results, cut at a word
+        """
+        length = Params.SNIPPET_LENGTH if length is None else length
+        body = " ".join(" ".join(v.split()) for k, v in sections.items() if k != 'abstract' and v)
+        if len(body) <= length:
+            return body
+        cut = body.rfind(' ', 0, length)
+        return body[:cut if cut > 0 else length] + '...'
+
     @staticmethod
     def insert_raw_documents(raw_documents):
         """
@@ -136,6 +197,7 @@ class Database:
             with session.start_transaction():
                 documents = [Database.format_document_from_raw(doc) for doc in raw_documents]
                 Connection.DB.documents.insert_many(documents)
+        Database.DOCUMENTS_CACHE.invalidate_many([doc['hash_id'] for doc in raw_documents])
 
     @staticmethod
     def insert_raw_document(raw_document):
@@ -147,12 +209,18 @@ class Database:
             with session.start_transaction():
                 doc = Database.format_document_from_raw(raw_document)
                 Connection.DB.documents.insert_one(doc)
+        Database.DOCUMENTS_CACHE.invalidate(raw_document['hash_id'])
 
     """
     ==============================================================================
         UPDATE
     ==============================================================================
     """
+    @staticmethod
+    def format_stale_embeddings():
+        # Set along new contents, legacy embeddings (no hash yet) of the document are not adopted as up to date
+        return {f'embeddings_hash.{method}': None for method in Database.list_methods()}
+
     @staticmethod
     def update_raw_documents(raw_documents):
         """
@@ -164,8 +232,9 @@ class Database:
         """
         with Connection.CLIENT.start_session() as session:
             with session.start_transaction():
-                for doc in clean_documents:
-                    Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': {'raw': doc}}, upsert=True)
+                for doc in raw_documents:
+                    Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': dict({'raw': doc, 'sources_hash.raw': Database.compute_sources_hash(doc.get('sections', {}))}, **Database.format_stale_embeddings())}, upsert=True)
+        Database.DOCUMENTS_CACHE.invalidate_many([doc['hash_id'] for doc in raw_documents])
 
     @staticmethod
     def update_clean_documents(clean_documents):
@@ -179,22 +248,210 @@ class Database:
         with Connection.CLIENT.start_session() as session:
             with session.start_transaction():
                 for doc in clean_documents:
-                    Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': {'clean': doc}}, upsert=True)
+                    Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': {'clean': doc, 'sources_hash.clean': Database.compute_sources_hash(doc.get('sections', {}))}}, upsert=True)
+        Database.DOCUMENTS_CACHE.invalidate_many([doc['hash_id'] for doc in clean_documents])
+
+    """
+    ==============================================================================
+        VECTOR ENCODING
+    ==============================================================================
+    """
+    # b'NV' + dtype char + format version + little-endian uint32 dimensions, then the raw values
+    VECTOR_MAGIC = b'NV'
+    VECTOR_HEADER = struct.Struct('<2sccI')
+    VECTOR_DTYPES = {'float32': (b'f', np.dtype('<f4')), 'float16': (b'e', np.dtype('<f2'))}
+    VECTOR_CODES = {code: dtype for code, dtype in VECTOR_DTYPES.values()}
+
+    @staticmethod
+    def encode_vector(vector, dtype=None):
+        code, np_dtype = Database.VECTOR_DTYPES[Params.EMBEDDINGS_DTYPE if dtype is None else dtype]
+        vector = np.ascontiguousarray(vector, dtype=np_dtype).reshape(-1)
+        return Binary(Database.VECTOR_HEADER.pack(Database.VECTOR_MAGIC, code, b'\x01', len(vector)) + vector.tobytes())
+
+    @staticmethod
+    def decode_vector(data):
+        """
+            Read-only view over data (no copy), float16 vectors stay float16
+            Vectors written before the binary format are pickles, only read while migrate_embeddings has not run
+        """
+        if not data.startswith(Database.VECTOR_MAGIC):
+            if not Params.EMBEDDINGS_LEGACY_PICKLE:
+                raise ValueError('Pickled embedding found, run migrate_embeddings.py')
+            return pickle.loads(data)
+
+        _, code, _, num_dimensions = Database.VECTOR_HEADER.unpack_from(data)
+        return np.frombuffer(data, dtype=Database.VECTOR_CODES[code], count=num_dimensions, offset=Database.VECTOR_HEADER.size)
+
+    @staticmethod
+    def encode_sections_vector(sections_vector, dtype=None):
+        for k in sections_vector.keys():
+            if sections_vector[k] is not None:
+                sections_vector[k]['vector'] = Database.encode_vector(sections_vector[k]['vector'], dtype)
+        return sections_vector
+
+    @staticmethod
+    def format_embeddings_update(method, method_obj, sections_vector):
+        """
+            $set of a freshly computed document: its section vectors and the token weighted
+            document vector (doc_vectors.<method>), read as is by list_doc_embeddings
+        """
+        doc_vector = method_obj.get_mean_vector(sections_vector)
+        return {
+            f'sections_embeddings.{method}': Database.encode_sections_vector(sections_vector),
+            f'doc_vectors.{method}': Database.encode_vector(doc_vector) if doc_vector is not None else None
+        }
+
+    @staticmethod
+    def update_doc_vectors(methods=None, batch_size=500):
+        """
+            Fills doc_vectors of documents embedded before it existed, from their section vectors
+        """
+        num_updated = 0
+        for method in (Database.list_methods() if methods is None else methods):
+            method_obj = Database.get_method(method)
+            query_dict = {f'sections_embeddings.{method}': {'$exists': True}, f'doc_vectors.{method}': {'$exists': False}}
+            projection = {'hash_id': 1, 'sections_embeddings': f'$sections_embeddings.{method}', '_id': 0}
+
+            requests = []
+            for doc in tqdm(Connection.DB.documents.aggregate([{'$match': query_dict}, {'$project': projection}])):
+                doc_vector = Database.read_mean_embedding(method_obj, doc)['vector']
+                doc_vector = Database.encode_vector(doc_vector) if doc_vector is not None else None
+                requests.append(UpdateOne({'hash_id': doc['hash_id']}, {'$set': {f'doc_vectors.{method}': doc_vector}}))
+                if len(requests) >= batch_size:
+                    num_updated += Connection.DB.documents.bulk_write(requests, ordered=False).modified_count
+                    requests = []
+            if len(requests) > 0:
+                num_updated += Connection.DB.documents.bulk_write(requests, ordered=False).modified_count
+        return num_updated
+
+    @staticmethod
+    def migrate_embeddings(methods=None, dtype=None, batch_size=500):
+        """
+            Rewrites pickled section vectors with the binary encoding (and dtype), returns the updated documents
+        """
+        methods = Database.list_methods() if methods is None else methods
+        projection = {'hash_id': 1, '_id': 0}
+        projection.update({f'sections_embeddings.{method}': 1 for method in methods})
+        code, _ = Database.VECTOR_DTYPES[Params.EMBEDDINGS_DTYPE if dtype is None else dtype]
+
+        num_updated = 0
+        requests = []
+        for doc in tqdm(Connection.DB.documents.find({}, projection)):
+            update = {}
+            for method, sections_vector in doc.get('sections_embeddings', {}).items():
+                for k, section_vector in sections_vector.items():
+                    if section_vector is None:
+                        continue
+                    data = section_vector['vector']
+                    if data.startswith(Database.VECTOR_MAGIC) and data[2:3] == code:
+                        continue
+                    vector = pickle.loads(data) if not data.startswith(Database.VECTOR_MAGIC) else Database.decode_vector(data)
+                    update[f'sections_embeddings.{method}.{k}.vector'] = Database.encode_vector(vector, dtype)
+
+            if len(update) > 0:
+                requests.append(UpdateOne({'hash_id': doc['hash_id']}, {'$set': update}))
+            if len(requests) >= batch_size:
+                num_updated += Connection.DB.documents.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if len(requests) > 0:
+            num_updated += Connection.DB.documents.bulk_write(requests, ordered=False).modified_count
+        return num_updated
 
     @staticmethod
     def fix_compute_mean_vector(use, func, doc):
-        return func(doc[use])
+        # Recorded by thread executors and the loop, process pools keep their own metrics
+        with METRICS.timer('coronagle_ingestion_seconds', stage='embed'):
+            return func(doc[use])
+
+    @staticmethod
+    def backfill_sources_hash(use='raw', batch_size=None, hash_ids=None):
+        """
+            Documents stored before content hashes existed get the hash of their stored use
+            sections, so they are not taken as changed (and embedded again) by sync_folder and
+            embeddings can be written conditionally on it. Documents updated meanwhile are skipped
+        """
+        batch_size = Params.INSERT_BATCH_SIZE if batch_size is None else batch_size
+        query_dict = {f'sources_hash.{use}': {'$exists': False}, use + '.sections': {'$exists': True}}
+        if hash_ids is not None:
+            query_dict['hash_id'] = {'$in': hash_ids}
+        requests = []
+        for doc in Connection.DB.documents.find(query_dict, {use + '.sections': 1, 'hash_id': 1, '_id': 0}):
+            requests.append(UpdateOne({'hash_id': doc['hash_id'], f'sources_hash.{use}': {'$exists': False}},
+                {'$set': {f'sources_hash.{use}': Database.compute_sources_hash(doc[use]['sections'])}}))
+            if len(requests) >= batch_size:
+                Connection.DB.documents.bulk_write(requests, ordered=False)
+                requests = []
+        if len(requests) > 0:
+            Connection.DB.documents.bulk_write(requests, ordered=False)
+
+    @staticmethod
+    def adopt_legacy_embeddings(method, use='raw', batch_size=None, hash_ids=None):
+        """
+            Documents embedded before content hashes existed are taken as up to date
+            with their current contents, instead of being embedded again (updated contents
+            mark their embeddings_hash stale, see format_stale_embeddings)
+            Expects sources_hash (backfill_sources_hash), documents changed since they were read are skipped
+        """
+        batch_size = Params.EMBEDDINGS_WRITE_BATCH if batch_size is None else batch_size
+        query_dict = {f'sections_embeddings.{method}': {'$exists': True}, f'embeddings_hash.{method}': {'$exists': False}, use + '.sections': {'$exists': True}}
+        if hash_ids is not None:
+            query_dict['hash_id'] = {'$in': hash_ids}
+        requests = []
+        for doc in Connection.DB.documents.find(query_dict, {use + '.sections': 1, 'hash_id': 1, '_id': 0}):
+            source_hash = Database.compute_sources_hash(doc[use]['sections'])
+            requests.append(UpdateOne({'hash_id': doc['hash_id'], f'sources_hash.{use}': source_hash}, {'$set': {f'embeddings_hash.{method}': source_hash}}))
+            if len(requests) >= batch_size:
+                Connection.DB.documents.bulk_write(requests, ordered=False)
+                requests = []
+        if len(requests) > 0:
+            Connection.DB.documents.bulk_write(requests, ordered=False)
 
     @staticmethod
-    def update_mean_vectors(method, use='raw', force=False):
+    def embeddings_version(method):
+        """
+            Counter of the embedding writes of method, exports made at an older one are stale
+        """
+        doc = Connection.DB.versions.find_one({'_id': 'embeddings:%s' % method})
+        return doc['version'] if doc is not None else 0
+
+    @staticmethod
+    def stale_embeddings_query(method, use='raw'):
+        # Missing, or computed from other contents than the current ones
+        return {use + '.sections': {'$exists': True}, '$or': [
+            {f'embeddings_hash.{method}': {'$exists': False}},
+            {'$expr': {'$ne': [f'$embeddings_hash.{method}', f'$sources_hash.{use}']}}
+        ]}
+
+    @staticmethod
+    def update_mean_vectors(method, use='raw', force=False, batch_size=None, page_size=None, hash_ids=None):
+        """
+            Embeds the documents never embedded by method or whose use sections changed since
+            (content hash), force embeds them all. Documents are streamed by _id in pages and a
+            checkpoint is saved after every page, a killed run resumes from it
+            batch_size: documents per unordered bulk_write (Params.EMBEDDINGS_WRITE_BATCH)
+            page_size: documents read per query and checkpoint (Params.EMBEDDINGS_PAGE_SIZE)
+            hash_ids: only these documents, without checkpoint nor progress bar (sync pipeline),
+                returns the ones written and still up to date
+        """
         assert('.' not in method and '$' not in method)
+        assert(use in ('raw', 'clean'))
         method_obj = Database.get_method(method)
+        batch_size = Params.EMBEDDINGS_WRITE_BATCH if batch_size is None else batch_size
+        page_size = Params.EMBEDDINGS_PAGE_SIZE if page_size is None else page_size
 
+        Database.backfill_sources_hash(use, hash_ids=hash_ids)
         if not force:
-            query_dict = {f'sections_embeddings.{method}': {'$exists': True}}
+            Database.adopt_legacy_embeddings(method, use, hash_ids=hash_ids)
+            query_dict = Database.stale_embeddings_query(method, use)
         else:
-            query_dict = {}
-        documents = Database.list_documents(query=query_dict, projection={use: 1, 'hash_id': 1, '_id': 0, f'sections_embeddings.{method}': 1})
+            query_dict = {use + '.sections': {'$exists': True}}
+        if hash_ids is not None:
+            query_dict['hash_id'] = {'$in': hash_ids}
+        # Partial runs are short and would overwrite the checkpoint of a full one
+        checkpoint_id = 'embed:%s:%s:%s' % (method, use, 'force' if force else 'incremental') if hash_ids is None else None
+        checkpoint = Connection.DB.checkpoints.find_one({'_id': checkpoint_id}) if checkpoint_id is not None else None
+        last_id = checkpoint['last_id'] if checkpoint is not None else None
+        projection = {use + '.sections': 1, 'hash_id': 1, '_id': 1}
 
         num_workers = Params.COMPUTE_VECTORS_WORKERS if not hasattr(method_obj, 'NUM_WORKERS') else method_obj.NUM_WORKERS
         use_loop = False
@@ -220,38 +477,88 @@ class Database:
         else:
             create_exec = lambda: cf.ThreadPoolExecutor(max_workers=num_workers)
 
-        if use_loop:
-            for doc in tqdm(documents):
-                sections_vector = method_obj.compute_mean_vector(doc[use])
-                with Connection.CLIENT.start_session() as session:
-                    with session.start_transaction():
-                        if force or method not in doc['sections_embeddings'].keys():
-                            for k in sections_vector.keys():
-                                if sections_vector[k] is not None:
-                                    sections_vector[k]['vector'] = Binary(pickle.dumps(sections_vector[k]['vector'], protocol=2))
-                            Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': {f'sections_embeddings.{method}': sections_vector}}, upsert=True)
-                
-        else: 
-            with create_exec() as executor:
-                for doc, sections_vector in zip(documents, tqdm(executor.map(partial(Database.fix_compute_mean_vector, use, method_obj.compute_mean_vector), documents), total=len(documents))):
-                    with Connection.CLIENT.start_session() as session:
-                        with session.start_transaction():
-                            if force or method not in doc['sections_embeddings'].keys():
-                                for k in sections_vector.keys():
-                                    if sections_vector[k] is not None:
-                                        sections_vector[k]['vector'] = Binary(pickle.dumps(sections_vector[k]['vector'], protocol=2))
-                                Connection.DB.documents.update_one({'hash_id': doc['hash_id']}, {'$set': {f'sections_embeddings.{method}': sections_vector}}, upsert=True)
+        def page_query():
+            return query_dict if last_id is None else {'$and': [query_dict, {'_id': {'$gt': last_id}}]}
+
+        # Every document update is independent, they are buffered and sent in unordered batches
+        progress = tqdm(total=Connection.DB.documents.count_documents(page_query()), unit='doc', disable=hash_ids is not None)
+        requests = []
+        num_written = 0
+        stored_hash_ids = []
+        a0 = time.time()
+        def flush():
+            nonlocal requests, num_written
+            if len(requests) > 0:
+                with METRICS.timer('coronagle_ingestion_seconds', stage='write'):
+                    Connection.DB.documents.bulk_write(requests, ordered=False)
+                Connection.DB.versions.update_one({'_id': 'embeddings:%s' % method}, {'$inc': {'version': 1}}, upsert=True)
+                num_written += len(requests)
+                requests = []
+                progress.set_postfix(written=num_written, writes_per_s='%.0f' % (num_written / max(time.time() - a0, 1e-6)))
+
+        def store(doc, sections_vector):
+            update = Database.format_embeddings_update(method, method_obj, sections_vector)
+            # The hash of the embedded contents, only written if they are still the stored ones
+            # (a document updated meanwhile is skipped and stays stale for the next run)
+            source_hash = Database.compute_sources_hash(doc[use]['sections'])
+            update[f'embeddings_hash.{method}'] = source_hash
+            requests.append(UpdateOne({'hash_id': doc['hash_id'], f'sources_hash.{use}': source_hash}, {'$set': update}))
+            if hash_ids is not None:
+                stored_hash_ids.append(doc['hash_id'])
+            if len(requests) >= batch_size:
+                flush()
+            METRICS.inc('coronagle_documents_total', stage='embed', method=method)
+            progress.update(1)
+
+        with (create_exec() if not use_loop else contextlib.nullcontext()) as executor:
+            while True:
+                documents = list(Connection.DB.documents.find(page_query(), projection).sort('_id', 1).limit(page_size))
+                if len(documents) == 0:
+                    break
+
+                if use_loop:
+                    sections_vectors = (Database.fix_compute_mean_vector(use, method_obj.compute_mean_vector, doc) for doc in documents)
+                else:
+                    sections_vectors = executor.map(partial(Database.fix_compute_mean_vector, use, method_obj.compute_mean_vector), documents)
+                for doc, sections_vector in zip(documents, sections_vectors):
+                    store(doc, sections_vector)
+                flush()
+
+                last_id = documents[-1]['_id']
+                if checkpoint_id is not None:
+                    Connection.DB.checkpoints.replace_one({'_id': checkpoint_id}, {'_id': checkpoint_id, 'last_id': last_id, 'written': num_written}, upsert=True)
+
+        # Done, the next run starts from the beginning (only new or changed documents match)
+        if checkpoint_id is not None:
+            Connection.DB.checkpoints.delete_one({'_id': checkpoint_id})
+        progress.close()
+
+        if hash_ids is not None:
+            # Writes of documents updated meanwhile did not match
+            query_dict = {'hash_id': {'$in': stored_hash_ids}, '$expr': {'$eq': [f'$embeddings_hash.{method}', f'$sources_hash.{use}']}}
+            return [doc['hash_id'] for doc in Connection.DB.documents.find(query_dict, {'hash_id': 1, '_id': 0})]
     """
     ==============================================================================
         GET
     ==============================================================================
     """
+    def translate_document(doc, projection):
+        for type_data in ['raw', 'clean']:
+            if type_data in projection.keys() and bool(projection[type_data]):
+                aux_sections = doc[type_data]['sections']
+                doc[type_data]['sections'] = {}
+                for k in aux_sections:
+                    fix_section = doc['sections_translation'][k]
+                    doc[type_data]['sections'][fix_section] = aux_sections[k]
+        return doc
+
     def list_documents(query={}, hash_ids=None, projection={}, use_translation=False):
         query_dict = {}
         if hash_ids is not None:
             query_dict['hash_id'] = {'$in': hash_ids}
         query_dict.update(query)
 
+        projection = dict(projection)
         if use_translation:
             projection.update({'sections_translation': 1})
         
@@ -260,22 +567,161 @@ class Database:
                 documents = []
                 for doc in Connection.DB.documents.find(query_dict, projection):
                     if use_translation:
-                        for type_data in ['raw', 'clean']:
-                            if type_data in projection.keys() and bool(projection[type_data]):
-                                aux_sections = doc[type_data]['sections']
-                                doc[type_data]['sections'] = {}
-                                for k in aux_sections:
-                                    fix_section = doc['sections_translation'][k]
-                                    doc[type_data]['sections'][fix_section] = aux_sections[k]
+                        Database.translate_document(doc, projection)
 
                     documents.append(doc)
 
                 return documents
         return []
 
+    """
+    ==============================================================================
+        STREAMING
+    ==============================================================================
+    """
+    def shard_query(shard, query={}):
+        """
+            shard: (i, n), returns the hash_id range of the i-th of n contiguous, equally sized
+            splits of the documents matching query. Consumers of every shard cover them all once
+        """
+        i, n = shard
+        assert(0 <= i < n)
+        num_docs = Connection.DB.documents.count_documents(query)
+        def bound(j):
+            if j <= 0 or j >= n:
+                return None
+            docs = list(Connection.DB.documents.find(query, {'hash_id': 1, '_id': 0}).sort('hash_id', 1).skip(j * num_docs // n).limit(1))
+            return docs[0]['hash_id'] if len(docs) > 0 else None
+
+        low, high = bound(i), bound(i + 1)
+        range_dict = {}
+        if low is not None:
+            range_dict['$gte'] = low
+        if high is not None:
+            range_dict['$lt'] = high
+        if i > 0 and low is None:
+            # Fewer documents than shards, only the first one gets them
+            range_dict = {'$in': []}
+        return {'hash_id': range_dict} if len(range_dict) > 0 else {}
+
+    def iter_documents(query={}, hash_ids=None, projection={}, use_translation=False, batch_size=None, shard=None):
+        """
+            Generator version of list_documents, for read-only scans: no session nor transaction,
+            documents are read in pages of batch_size (Params.CURSOR_BATCH_SIZE) by _id so memory
+            stays flat, and no cursor stays open while the consumer works (idle cursor timeout)
+            shard: optional (i, n), only the i-th of n splits of the matching documents
+        """
+        query_dict = {}
+        if hash_ids is not None:
+            query_dict['hash_id'] = {'$in': hash_ids}
+        query_dict.update(query)
+        if shard is not None:
+            query_dict = {'$and': [query_dict, Database.shard_query(shard, query_dict)]}
+
+        projection = dict(projection)
+        if use_translation:
+            projection.update({'sections_translation': 1})
+        # Pages need the _id, it is removed again when it was excluded
+        keep_id = projection.pop('_id', 1) != 0
+
+        batch_size = Params.CURSOR_BATCH_SIZE if batch_size is None else batch_size
+        last_id = None
+        while True:
+            page_query = query_dict if last_id is None else {'$and': [query_dict, {'_id': {'$gt': last_id}}]}
+            documents = list(Connection.DB.documents.find(page_query, projection or None).sort('_id', 1).limit(batch_size))
+            if len(documents) == 0:
+                break
+            last_id = documents[-1]['_id']
+
+            for doc in documents:
+                if not keep_id:
+                    del doc['_id']
+                if use_translation:
+                    Database.translate_document(doc, projection)
+                yield doc
+
+    def count_documents(query={}):
+        return Connection.DB.documents.count_documents(query)
+
+    def iter_raw_documents(hash_ids=None, use_translation=False, projection=None, batch_size=None, shard=None):
+        projection = {'raw': 1, 'hash_id': 1, '_id': 0, 'title': 1, 'url': 1} if projection is None else projection
+        return Database.iter_documents(hash_ids=hash_ids, projection=projection, use_translation=use_translation, batch_size=batch_size, shard=shard)
+
+    def iter_clean_documents(hash_ids=None, use_translation=False, projection=None, batch_size=None, shard=None):
+        projection = {'clean': 1, 'hash_id': 1, '_id': 0, 'title': 1, 'url': 1} if projection is None else projection
+        return Database.iter_documents(hash_ids=hash_ids, projection=projection, use_translation=use_translation, batch_size=batch_size, shard=shard)
+
+    def iter_doc_embeddings(method, hash_ids=None, batch_size=None, shard=None):
+        """
+            Generator version of list_doc_embeddings, {'vector', 'hash_id'} one document at a time
+        """
+        assert('.' not in method and '$' not in method)
+        method_obj = Database.get_method(method)
+        query_dict = {}
+        if hash_ids is not None:
+            query_dict['hash_id'] = {'$in': hash_ids}
+        if shard is not None:
+            # Same split for both passes
+            query_dict = {'$and': [query_dict, Database.shard_query(shard, query_dict)]}
+
+        query_stored = dict(query_dict, **{f'doc_vectors.{method}': {'$exists': True}})
+        for doc in Database.iter_documents(query=query_stored, projection={f'doc_vectors.{method}': 1, 'hash_id': 1, '_id': 0}, batch_size=batch_size):
+            yield Database.read_doc_vector(method, doc)
+
+        # Embedded before doc_vectors existed
+        query_legacy = dict(query_dict, **{f'doc_vectors.{method}': {'$exists': False}})
+        for doc in Database.iter_documents(query=query_legacy, projection={f'sections_embeddings.{method}': 1, 'hash_id': 1, '_id': 0}, batch_size=batch_size):
+            if method in doc.get('sections_embeddings', {}):
+                doc['sections_embeddings'] = doc['sections_embeddings'][method]
+            else:
+                doc.pop('sections_embeddings', None)
+            yield Database.read_mean_embedding(method_obj, doc)
+
     def list_raw_documents(hash_ids=None, use_translation=False):
         return Database.list_documents(hash_ids=hash_ids, projection={'raw': 1, 'hash_id': 1, '_id': 0, 'title': 1, 'url': 1}, use_translation=use_translation)
 
+    def list_search_results(hash_ids):
+        """
+            Only what a results page shows, in the order of hash_ids ($in does not keep it)
+            Hot documents come from DOCUMENTS_CACHE, misses are read in a single query
+        """
+        documents = {}
+        for hash_id in hash_ids:
+            doc = Database.DOCUMENTS_CACHE.get(hash_id)
+            if doc is not None:
+                documents[hash_id] = doc
+
+        missing = [hash_id for hash_id in hash_ids if hash_id not in documents]
+        if len(missing) > 0:
+            projection = {'hash_id': 1, 'title': 1, 'snippet': 1, 'raw.sections.abstract': 1, '_id': 0}
+            for doc in Connection.DB.documents.find({'hash_id': {'$in': missing}}, projection):
+                Database.DOCUMENTS_CACHE.put(doc['hash_id'], doc)
+                documents[doc['hash_id']] = doc
+        return [documents[hash_id] for hash_id in hash_ids if hash_id in documents]
+
+    def update_snippets(force=False, batch_size=500):
+        """
+            Fills the snippet of documents inserted before it existed, returns the updated documents
+        """
+        query_dict = {'raw.sections': {'$exists': True}} if force else {'snippet': {'$exists': False}, 'raw.sections': {'$exists': True}}
+        num_updated = 0
+        requests = []
+        hash_ids = []
+        def flush():
+            nonlocal num_updated, requests, hash_ids
+            num_updated += Connection.DB.documents.bulk_write(requests, ordered=False).modified_count
+            Database.DOCUMENTS_CACHE.invalidate_many(hash_ids)
+            requests, hash_ids = [], []
+
+        for doc in tqdm(Connection.DB.documents.find(query_dict, {'hash_id': 1, 'raw.sections': 1, '_id': 0})):
+            requests.append(UpdateOne({'hash_id': doc['hash_id']}, {'$set': {'snippet': Database.compute_snippet(doc['raw']['sections'])}}))
+            hash_ids.append(doc['hash_id'])
+            if len(requests) >= batch_size:
+                flush()
+        if len(requests) > 0:
+            flush()
+        return num_updated
+
     def list_clean_documents(hash_ids=None, use_translation=False):
         return Database.list_documents(hash_ids=hash_ids, projection={'clean': 1, 'hash_id': 1, '_id': 0, 'title': 1, 'url': 1}, use_translation=use_translation)
 
@@ -289,7 +735,7 @@ class Database:
         else:
             for k in doc['sections_embeddings'].keys():
                 if doc['sections_embeddings'][k] is not None:
-                    doc['sections_embeddings'][k]['vector'] = pickle.loads(doc['sections_embeddings'][k]['vector'])
+                    doc['sections_embeddings'][k]['vector'] = Database.decode_vector(doc['sections_embeddings'][k]['vector'])
 
             mean_vector = method_obj.get_mean_vector(doc['sections_embeddings'])
 
@@ -298,7 +744,19 @@ class Database:
             'hash_id': doc['hash_id']
         }
 
+    def read_doc_vector(method, doc):
+        data = doc['doc_vectors'][method]
+        return {
+            'vector': Database.decode_vector(data) if data is not None else None,
+            'hash_id': doc['hash_id']
+        }
+
+    @METRICS.timed('coronagle_ingestion_seconds', stage='load_embeddings')
     def list_doc_embeddings(method, hash_ids=None, cache=True):
+        """
+            One stored vector per document (doc_vectors), documents embedded before
+            it existed fall back to the mean of their section vectors
+        """
         assert('.' not in method and '$' not in method)
         method_obj = Database.get_method(method)
         query_dict = {}
@@ -307,10 +765,13 @@ class Database:
 
         with Connection.CLIENT.start_session() as session:
             with session.start_transaction():
-                output_vectors = []
+                query_stored = dict(query_dict, **{f'doc_vectors.{method}': {'$exists': True}})
+                list_docs = Connection.DB.documents.find(query_stored, {f'doc_vectors.{method}': 1, 'hash_id': 1, '_id': 0})
+                output_vectors = [Database.read_doc_vector(method, doc) for doc in list_docs]
 
                 with cf.ThreadPoolExecutor(max_workers=Params.READ_EMBEDDINGS_WORKERS) as executor:
                     list_docs = Connection.DB.documents.aggregate([
+                        {'$match': dict(query_dict, **{f'doc_vectors.{method}': {'$exists': False}})},
                         {'$project': {'sections_translation': 1, 'sections_embeddings': f'$sections_embeddings.{method}', 'hash_id': 1, '_id': 0}}
                     ])
                     for vec in executor.map(partial(Database.read_mean_embedding, method_obj), list_docs):
@@ -319,23 +780,97 @@ class Database:
                 return output_vectors
         return []
 
-    def read_mean_embedding_from_section(method_obj, use_translation, doc):
+    def list_hash_ids():
+        return [doc['hash_id'] for doc in Connection.DB.documents.find({}, {'hash_id': 1, '_id': 0})]
+
+    def read_doc_tokens(doc):
+        tokens = []
+        for v_text in doc['raw']['sections'].values():
+            c_text = clean_text(v_text)
+            if c_text is not None:
+                tokens += c_text.split()
+
+        return {
+            'tokens': tokens,
+            'hash_id': doc['hash_id']
+        }
+
+    def list_sources_hashes(use='raw'):
+        """
+            (hash_id, sources_hash of use) of every document, None for documents stored before
+            content hashes existed (see backfill_sources_hash)
+        """
+        projection = {'hash_id': 1, f'sources_hash.{use}': 1, '_id': 0}
+        return [(doc['hash_id'], doc.get('sources_hash', {}).get(use, None)) for doc in Database.iter_documents(projection=projection)]
+
+    def list_doc_tokens(hash_ids=None):
+        """
+            clean_text tokens of every raw section, input of the lexical (BM25) index
+        """
+        return list(Database.iter_doc_tokens(hash_ids))
+
+    def iter_doc_tokens(hash_ids=None, batch_size=None):
+        """
+            Generator version of list_doc_tokens, documents are read with iter_documents and
+            tokenized a page at a time, only one page of tokens is held
+        """
+        batch_size = Params.CURSOR_BATCH_SIZE if batch_size is None else batch_size
+        documents = Database.iter_documents(hash_ids=hash_ids, projection={'raw.sections': 1, 'hash_id': 1, '_id': 0}, batch_size=batch_size)
+        with cf.ThreadPoolExecutor(max_workers=Params.READ_EMBEDDINGS_WORKERS) as executor:
+            while True:
+                page = list(itertools.islice(documents, batch_size))
+                if len(page) == 0:
+                    break
+                yield from executor.map(Database.read_doc_tokens, page)
+
+    # Canonical sections, used when the section detector did not fill sections_translation
+    SECTIONS_KEYWORDS = {
+        'abstract': ['abstract'],
+        'method': ['method', 'material', 'procedure'],
+        'results': ['result', 'experiment', 'analysis', 'evaluation', 'statistic'],
+        'conclusions': ['conclusion', 'discussion'],
+    }
+    SECTIONS_ALIASES = {
+        'experiments_or_results': 'results'
+    }
+
+    @staticmethod
+    def translate_section(section, sections_translation=None):
+        """
+            Canonical name (Params.SEARCH_SECTIONS) of a section title, None if it has no match
+        """
+        if sections_translation and section in sections_translation:
+            translated = sections_translation[section].lstrip('#')
+            return Database.SECTIONS_ALIASES.get(translated, translated)
+
+        section_name = section.lower()
+        for canonical, keywords in Database.SECTIONS_KEYWORDS.items():
+            if any(keyword in section_name for keyword in keywords):
+                return canonical
+        return None
+
+    def read_mean_embedding_from_sections(method_obj, sections, use_translation, doc):
+        output_vectors = {section: {'vector': None, 'hash_id': doc['hash_id']} for section in sections}
+        if 'sections_embeddings' not in doc:
+            return output_vectors
+
+        for k in doc['sections_embeddings'].keys():
+            if doc['sections_embeddings'][k] is not None:
+                doc['sections_embeddings'][k]['vector'] = Database.decode_vector(doc['sections_embeddings'][k]['vector'])
+
         if use_translation:
-            translation_lut = doc['sections_translation']
+            translation_lut = {k: Database.translate_section(k, doc.get('sections_translation', None)) for k in doc['sections_embeddings'].keys()}
         else:
             translation_lut = None
 
-        for k in doc['sections_embeddings'].keys():
-            if doc['sections_embeddings'][k] is not None:
-                doc['sections_embeddings'][k]['vector'] = pickle.loads(doc['sections_embeddings'][k]['vector'])
-        
-        mean_vector = method_obj.get_mean_vector_from_section(doc['sections_embeddings'], section, translation_lut)
-        output_vectors.append({
-            'vector': mean_vector,
-            'hash_id': doc['hash_id']
-        })
+        for section in sections:
+            output_vectors[section]['vector'] = method_obj.get_mean_vector_from_section(doc['sections_embeddings'], section, translation_lut)
+        return output_vectors
 
-    def list_doc_embeddings_from_section(method, section, hash_ids=None, use_translation=False):
+    def list_doc_embeddings_from_sections(method, sections, hash_ids=None, use_translation=False):
+        """
+            Single pass over the collection, returns {section: [{'vector', 'hash_id'}]}
+        """
         assert('.' not in method and '$' not in method)
         method_obj = Database.get_method(method)
         query_dict = {}
@@ -344,17 +879,22 @@ class Database:
 
         with Connection.CLIENT.start_session() as session:
             with session.start_transaction():
-                output_vectors = []
+                output_vectors = {section: [] for section in sections}
 
                 with cf.ThreadPoolExecutor(max_workers=Params.READ_EMBEDDINGS_WORKERS) as executor:
                     list_docs = Connection.DB.documents.aggregate([
+                        {'$match': query_dict},
                         {'$project': {'sections_translation': 1, 'sections_embeddings': f'$sections_embeddings.{method}', 'hash_id': 1, '_id': 0}}
                     ])
-                    for vec in executor.map(partial(Database.read_mean_embedding_from_section, method_obj, use_translation), list_docs):
-                        output_vectors.append(vec)
+                    for vecs in executor.map(partial(Database.read_mean_embedding_from_sections, method_obj, sections, use_translation), list_docs):
+                        for section in sections:
+                            output_vectors[section].append(vecs[section])
                     
                 return output_vectors
-        return []
+        return {}
+
+    def list_doc_embeddings_from_section(method, section, hash_ids=None, use_translation=False):
+        return Database.list_doc_embeddings_from_sections(method, [section], hash_ids=hash_ids, use_translation=use_translation)[section]
     
     """
     ==============================================================================
@@ -371,15 +911,12 @@ class Database:
     @staticmethod
     def parse_document_json(json_path):
         data = {}
-        with open(json_path) as json_file:
+        with open(json_path, 'rb') as json_file:
             try:
-                json_data = json.load(json_file)
+                json_data = json_loads(json_file.read())
             except:
                 return None
 
-            if Database.exists(json_data['paper_id']):
-                return None
-
             data['hash_id'] = json_data['paper_id']
             data['title'] = json_data['metadata']['title']
             data['authors'] = json_data['metadata']['authors']
@@ -412,25 +949,61 @@ class Database:
                     sections_order[section] = True
             
             data['sections_order'] = list(sections_order.keys())
+            # Plain dicts, documents travel back from the scan processes pickled
+            data['citations'] = dict(data['citations'])
+            data['sections'] = dict(data['sections'])
         
         return data
 
     @staticmethod
     def scan_file(json_path):
-        return Database.parse_document_json(json_path)
+        """
+            Runs in the scan process pool, returns (raw document, parse seconds), the time is
+            recorded by the parent (the METRICS of a child process are lost)
+        """
+        a0 = time.perf_counter()
+        raw_doc = Database.parse_document_json(json_path)
+        return raw_doc, time.perf_counter() - a0
 
     @staticmethod
-    def scan_folder(folder_path):
+    def insert_many_unordered(documents):
+        with METRICS.timer('coronagle_ingestion_seconds', stage='insert'):
+            Connection.DB.documents.insert_many(documents, ordered=False)
+        METRICS.inc('coronagle_documents_total', value=len(documents), stage='insert')
+        Database.DOCUMENTS_CACHE.invalidate_many([doc['hash_id'] for doc in documents])
+
+    @staticmethod
+    def scan_folder(folder_path, batch_size=None):
+        """
+            Inserts the papers of every subfolder not in the database yet. The existing hash_ids are
+            read once, files named after a known paper_id are not even opened, the rest are parsed
+            in a process pool (Params.SCAN_WORKERS) and inserted in unordered batches
+        """
+        batch_size = Params.INSERT_BATCH_SIZE if batch_size is None else batch_size
+        existing = set(Database.list_hash_ids())
         documents = []
-        for folder_path in filter(lambda folder_path: os.path.isdir(folder_path), glob2.iglob(os.path.join(folder_path, "*"))):
-            folder_name = os.path.basename(folder_path)
-            print('\tProcessing %s folder' % (folder_name, ))
-            with cf.ThreadPoolExecutor(max_workers=Params.SCAN_WORKERS) as executor:
+        pending = []
+        with cf.ProcessPoolExecutor(max_workers=Params.SCAN_WORKERS) as executor:
+            for folder_path in filter(lambda folder_path: os.path.isdir(folder_path), glob2.iglob(os.path.join(folder_path, "*"))):
+                folder_name = os.path.basename(folder_path)
+                print('\tProcessing %s folder' % (folder_name, ))
                 list_jsons = glob2.glob(os.path.join(folder_path, "**", "*.json"))
-                for raw_doc in tqdm(executor.map(Database.scan_file, list_jsons), total=len(list_jsons)):
-                    if raw_doc is not None:
-                        Database.insert_raw_document(raw_doc)
-                        documents.append(raw_doc)
+                list_jsons = [json_path for json_path in list_jsons if os.path.splitext(os.path.basename(json_path))[0] not in existing]
+                chunksize = max(1, min(64, len(list_jsons) // (4 * Params.SCAN_WORKERS)))
+                for raw_doc, elapsed in tqdm(executor.map(Database.scan_file, list_jsons, chunksize=chunksize), total=len(list_jsons)):
+                    METRICS.observe('coronagle_ingestion_seconds', elapsed, stage='parse')
+                    # Same paper in several folders (pdf_json / pmc_json) or already inserted
+                    if raw_doc is None or raw_doc['hash_id'] in existing:
+                        continue
+                    existing.add(raw_doc['hash_id'])
+                    pending.append(Database.format_document_from_raw(raw_doc))
+                    documents.append(raw_doc)
+                    if len(pending) >= batch_size:
+                        Database.insert_many_unordered(pending)
+                        pending = []
+
+        if len(pending) > 0:
+            Database.insert_many_unordered(pending)
 
         # Return
         return documents
@@ -441,37 +1014,293 @@ class Database:
     ==============================================================================
     """
     @staticmethod
-    def sync(callback_preprocessing=None):
-        # Lazy loading to avoid asking for credentials when not syncing
-        import kaggle
-        is_processing = False
+    def list_dataset_files(folder_path):
+        """
+            JSONs of every subfolder (as scan_folder), {path relative to folder_path: os.stat}
+        """
+        files = {}
+        for subfolder_path in filter(lambda subfolder_path: os.path.isdir(subfolder_path), glob2.iglob(os.path.join(folder_path, "*"))):
+            for json_path in glob2.glob(os.path.join(subfolder_path, "**", "*.json")):
+                files[os.path.relpath(json_path, folder_path)] = os.stat(json_path)
+        return files
 
-        def __sync_thread():
-            nonlocal is_processing
-            if is_processing:
-                return
+    @staticmethod
+    def scan_changed_file(json_path, known_hash=None):
+        """
+            returns (content hash of the file, raw document, parse seconds), the document is None
+            when the file content is known_hash (only touched) or can not be parsed
+        """
+        a0 = time.perf_counter()
+        with open(json_path, 'rb') as json_file:
+            data = json_file.read()
+        content_hash = hashlib.sha1(data).hexdigest()
+        if content_hash == known_hash:
+            return content_hash, None, time.perf_counter() - a0
+        return content_hash, Database.parse_document_json(json_path), time.perf_counter() - a0
 
-            is_processing = True
-            print('Checking new changes...')
-            
-            # Download from kaggle
-            kaggle.api.authenticate()
-            kaggle.api.dataset_download_files(Params.DATASET_KAGGLE_NAME, path=Params.DATASET_KAGGLE_RAW, unzip=True)
+    @staticmethod
+    def format_document_update_from_raw(raw_document):
+        # Only the fields coming from the JSON, embeddings are refreshed by update_mean_vectors (sources_hash)
+        document = Database.format_document_from_raw(raw_document)
+        return dict({k: document[k] for k in ['title', 'raw', 'sections_order', 'snippet', 'sources_hash']}, **Database.format_stale_embeddings())
 
-            # Create new dataset with the changes
-            raw_documents = Database.scan_folder(Params.DATASET_KAGGLE_RAW)
-            
-            # Execute callback
+    @staticmethod
+    def sync_folder(folder_path, batch_size=None, on_written=None):
+        """
+            Incremental scan of folder_path driven by the manifest collection
+            (path -> size, mtime, content hash, hash_id), persisted between runs:
+            - same size and mtime: skipped without reading
+            - same content hash (e.g. unzipped again): only the manifest is touched
+            - otherwise parsed, new papers are inserted and changed ones updated in place
+            returns the inserted and updated raw documents, or passes them to on_written(raw documents)
+            after every batch is written instead (the sync pipeline does not wait for the whole scan)
+        """
+        batch_size = Params.INSERT_BATCH_SIZE if batch_size is None else batch_size
+        manifest = {entry['_id']: entry for entry in Connection.DB.manifest.find({})}
+        files = Database.list_dataset_files(folder_path)
+        changed = [path for path, stat in files.items()
+            if path not in manifest or manifest[path]['size'] != stat.st_size or manifest[path]['mtime_ns'] != stat.st_mtime_ns]
+        print('\t%d files, %d new or modified' % (len(files), len(changed)))
+
+        # Stored content of every paper, updates are only written when it really changed
+        Database.backfill_sources_hash('raw')
+        sources_hash = {doc['hash_id']: doc.get('sources_hash', {}).get('raw', None)
+            for doc in Connection.DB.documents.find({}, {'hash_id': 1, 'sources_hash.raw': 1, '_id': 0})}
+
+        documents = []
+        inserts, updates, updated_hash_ids, manifest_requests = [], [], [], []
+        inserted_documents, updated_documents = [], []
+        def written(raw_documents):
+            if on_written is not None:
+                on_written(raw_documents)
+            else:
+                documents.extend(raw_documents)
+
+        def flush(force=False):
+            nonlocal inserts, updates, updated_hash_ids, manifest_requests, inserted_documents, updated_documents
+            # There are more manifest entries than documents, when they are written every document
+            # buffered so far (from those same files) is written before them
+            force = force or len(manifest_requests) >= batch_size
+            if len(inserts) > 0 and (force or len(inserts) >= batch_size):
+                Database.insert_many_unordered(inserts)
+                written(inserted_documents)
+                inserts, inserted_documents = [], []
+            if len(updates) > 0 and (force or len(updates) >= batch_size):
+                with METRICS.timer('coronagle_ingestion_seconds', stage='update'):
+                    Connection.DB.documents.bulk_write(updates, ordered=False)
+                METRICS.inc('coronagle_documents_total', value=len(updates), stage='update')
+                Database.DOCUMENTS_CACHE.invalidate_many(updated_hash_ids)
+                written(updated_documents)
+                updates, updated_hash_ids, updated_documents = [], [], []
+            # The manifest goes last, a crash before it just scans those files again
+            if len(manifest_requests) > 0 and force:
+                Connection.DB.manifest.bulk_write(manifest_requests, ordered=False)
+                manifest_requests = []
+
+        seen = set()
+        known_hashes = [manifest[path]['content_hash'] if path in manifest else None for path in changed]
+        with cf.ProcessPoolExecutor(max_workers=Params.SCAN_WORKERS) as executor:
+            json_paths = [os.path.join(folder_path, path) for path in changed]
+            chunksize = max(1, min(64, len(changed) // (4 * Params.SCAN_WORKERS)))
+            for path, (content_hash, raw_doc, elapsed) in zip(changed, tqdm(executor.map(Database.scan_changed_file, json_paths, known_hashes, chunksize=chunksize), total=len(changed))):
+                METRICS.observe('coronagle_ingestion_seconds', elapsed, stage='parse')
+                entry = {'_id': path, 'size': files[path].st_size, 'mtime_ns': files[path].st_mtime_ns, 'content_hash': content_hash,
+                    'hash_id': manifest[path]['hash_id'] if path in manifest else None}
+
+                # Same paper in several folders (pdf_json / pmc_json): the first file of the run wins
+                if raw_doc is not None and raw_doc['hash_id'] not in seen:
+                    hash_id = entry['hash_id'] = raw_doc['hash_id']
+                    seen.add(hash_id)
+                    new_hash = Database.compute_sources_hash(raw_doc['sections'])
+                    if hash_id not in sources_hash:
+                        inserts.append(Database.format_document_from_raw(raw_doc))
+                        inserted_documents.append(raw_doc)
+                    elif sources_hash[hash_id] != new_hash:
+                        updates.append(UpdateOne({'hash_id': hash_id}, {'$set': Database.format_document_update_from_raw(raw_doc)}))
+                        updated_hash_ids.append(hash_id)
+                        updated_documents.append(raw_doc)
+                    sources_hash[hash_id] = new_hash
+
+                manifest_requests.append(ReplaceOne({'_id': path}, entry, upsert=True))
+                flush()
+        flush(force=True)
+
+        # Files gone from the folder, their papers stay (they may come from other files)
+        removed = [path for path in manifest if path not in files]
+        if len(removed) > 0:
+            Connection.DB.manifest.delete_many({'_id': {'$in': removed}})
+        return documents
+
+    @staticmethod
+    def create_sync_pipeline(source, callback_preprocessing=None, callback_index=None, methods=None, callback_done=None):
+        """
+            source(emit) -> clean -> embed, one stage per method -> index, each stage with its
+            own workers (Params.PIPELINE_WORKERS) and batches (Params.PIPELINE_BATCH_SIZE)
+            source emits raw documents once they are written, the next stages pick them up
+            meanwhile, a full queue blocks the stage feeding it
+            callback_preprocessing(raw documents): called by the clean stage for every batch
+            callback_index(method, hash_ids): called with the freshly embedded documents
+            callback_done(method, hash_ids): the embed stage of method is done with these documents,
+                embedded or not (up to date already, updated meanwhile, or dropped after failing)
+        """
+        methods = Database.list_methods() if methods is None else methods
+        workers, batch_size = Params.PIPELINE_WORKERS, Params.PIPELINE_BATCH_SIZE
+
+        def clean(raw_documents):
+            with METRICS.timer('coronagle_ingestion_seconds', stage='clean'):
+                clean_documents = [{'hash_id': doc['hash_id'], 'sections': {k: clean_text(v) for k, v in doc['sections'].items()}} for doc in raw_documents]
+            Database.update_clean_documents(clean_documents)
+            METRICS.inc('coronagle_documents_total', value=len(clean_documents), stage='clean')
             if callback_preprocessing is not None:
                 callback_preprocessing(raw_documents)
+            return [doc['hash_id'] for doc in raw_documents]
 
-            # Is done
-            is_processing = False
-        
-        t = Thread(target=__sync_thread)
-        t.start()
+        def embed(method, hash_ids):
+            # Only the ones still stale, e.g. a paper in several batches of the same run, and only
+            # the ones written are indexed
+            written_hash_ids = Database.update_mean_vectors(method, hash_ids=hash_ids)
+            done(method, hash_ids)
+            return [(method, hash_id) for hash_id in written_hash_ids]
 
-        schedule.every().hour.do(__sync_thread)
-        while True:
-            schedule.run_pending()
-            time.sleep(3600)
+        def done(method, hash_ids):
+            if callback_done is not None:
+                callback_done(method, hash_ids)
+
+        def drop_clean(raw_documents):
+            for method in methods:
+                done(method, [doc['hash_id'] for doc in raw_documents])
+
+        def index(items):
+            hash_ids = defaultdict(list)
+            for method, hash_id in items:
+                hash_ids[method].append(hash_id)
+            if callback_index is not None:
+                for method, method_hash_ids in hash_ids.items():
+                    callback_index(method, method_hash_ids)
+
+        index_stage = Stage('index', index, num_workers=workers['index'], batch_size=batch_size['index'])
+        embed_stages = [Stage('embed:%s' % method, partial(embed, method), num_workers=workers['embed'], batch_size=batch_size['embed'],
+            on_drop=partial(done, method)).connect(index_stage) for method in methods]
+        clean_stage = Stage('clean', clean, num_workers=workers['clean'], batch_size=batch_size['clean'], on_drop=drop_clean).connect(*embed_stages)
+        return Pipeline(source, [clean_stage], [clean_stage] + embed_stages + [index_stage], source_name='scan')
+
+    @staticmethod
+    def acquire_lease(name, owner, seconds):
+        """
+            Takes the lease name for seconds when it is free or expired, or renews it when owner
+            already holds it. Returns whether owner holds it, across the processes and hosts
+            sharing the database (the upsert of a held lease fails on its _id)
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            Connection.DB.leases.find_one_and_update({'_id': name, '$or': [{'owner': owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'expires': now + datetime.timedelta(seconds=seconds)}}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    @staticmethod
+    def release_lease(name, owner):
+        Connection.DB.leases.delete_one({'_id': name, 'owner': owner})
+
+    @staticmethod
+    def sync(callback_preprocessing=None, folder_path=None, callback_index=None, once=False):
+        """
+            Every Params.SYNC_INTERVAL_HOURS, downloads the Kaggle dataset (only when folder_path
+            is None) and applies the new and changed papers of the folder with sync_folder, they
+            flow through the sync pipeline (see create_sync_pipeline) while the scan goes on
+            folder_path: pre-populated local dataset folder, no Kaggle access needed
+            once: a single scan, returns when every stage has drained
+            Every scan first sends again the papers whose embeddings are stale for some method,
+            except the ones still in the pipeline
+            A failed scan is printed and counted (stage scan of coronagle_pipeline_errors_total),
+            the next one retries, except with once where it raises
+            Only one process syncs a database at a time, the one holding the sync lease (see
+            acquire_lease), every server worker can run it and the others wait to take over
+            (once returns when the lease is held by another process)
+        """
+        owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        stopped = Event()
+        methods = Database.list_methods()
+        # Embed stages still to go through per paper in the pipeline
+        in_flight = defaultdict(int)
+        in_flight_lock = Lock()
+
+        def send(emit, raw_documents, skip_in_flight=False):
+            with in_flight_lock:
+                if skip_in_flight:
+                    raw_documents = [doc for doc in raw_documents if doc['hash_id'] not in in_flight]
+                for doc in raw_documents:
+                    in_flight[doc['hash_id']] += len(methods)
+            if len(raw_documents) > 0:
+                emit(raw_documents)
+
+        def done(method, hash_ids):
+            with in_flight_lock:
+                for hash_id in hash_ids:
+                    in_flight[hash_id] -= 1
+                    if in_flight[hash_id] <= 0:
+                        del in_flight[hash_id]
+
+        def renew_lease():
+            while not stopped.wait(Params.SYNC_LEASE_SECONDS / 3):
+                if not Database.acquire_lease('sync', owner, Params.SYNC_LEASE_SECONDS):
+                    print('Sync lease taken by another process')
+
+        def scan_once(emit):
+            # Papers left stale by batches that failed in previous runs go through again
+            Database.backfill_sources_hash('raw')
+            Database.update_snippets()
+            for method in methods:
+                Database.adopt_legacy_embeddings(method)
+            stale_query = {'$or': [Database.stale_embeddings_query(method) for method in methods]}
+            raw_documents = (dict(doc['raw'], hash_id=doc['hash_id']) for doc in Database.iter_documents(query=stale_query, projection={'raw': 1, 'hash_id': 1, '_id': 0})) \
+                if len(methods) > 0 else iter([])
+            while True:
+                batch = list(itertools.islice(raw_documents, Params.INSERT_BATCH_SIZE))
+                if len(batch) == 0:
+                    break
+                send(emit, batch, skip_in_flight=True)
+
+            print('Checking new changes...')
+            if folder_path is None:
+                # Lazy loading to avoid asking for credentials when not syncing from Kaggle
+                import kaggle
+                kaggle.api.authenticate()
+                kaggle.api.dataset_download_files(Params.DATASET_KAGGLE_NAME, path=Params.DATASET_KAGGLE_RAW, unzip=True)
+
+            # Only new or changed files are read
+            # New contents go through even if the paper is in the pipeline already
+            Database.sync_folder(Params.DATASET_KAGGLE_RAW if folder_path is None else folder_path, on_written=partial(send, emit))
+
+        def scan(emit):
+            renewing = False
+            while True:
+                a0 = time.time()
+                # Checked again every scan, a process that lost it (e.g. paused past its expiration) stops
+                if not Database.acquire_lease('sync', owner, Params.SYNC_LEASE_SECONDS):
+                    if once:
+                        print('Sync running in another process')
+                        return
+                    time.sleep(Params.SYNC_LEASE_SECONDS / 2)
+                    continue
+                if not renewing:
+                    Thread(target=renew_lease, daemon=True).start()
+                    renewing = True
+                try:
+                    scan_once(emit)
+                except Exception:
+                    # A failed scan (Kaggle, Mongo...) must not end the sync, the next one retries
+                    if once:
+                        raise
+                    traceback.print_exc()
+                    METRICS.inc('coronagle_pipeline_errors_total', stage='scan')
+                if once:
+                    return
+                time.sleep(max(0, Params.SYNC_INTERVAL_HOURS * 3600 - (time.time() - a0)))
+
+        try:
+            Database.create_sync_pipeline(scan, callback_preprocessing, callback_index, methods, callback_done=done).run()
+        finally:
+            stopped.set()
+            Database.release_lease('sync', owner)
@@ -0,0 +1,7 @@
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from database_core import *
+
+# Run after every embedding update, server workers pick the new version up on restart
+methods = sys.argv[1:] if len(sys.argv) > 1 else None
+EmbeddingsStore.export(methods=methods)
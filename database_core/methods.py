@@ -1,10 +1,23 @@
 from . import clean_text
 from . import Database
+from . import LRUCache
+from . import Params
+from . import METRICS
 import numpy as np
 
+# Query vectors keyed by (method name, cleaned text), repeated queries skip the model
+QUERY_CACHE = LRUCache(Params.QUERY_CACHE_SIZE, Params.QUERY_CACHE_TTL)
+
+def cache_query_vector(name, c_text, vector):
+    vector = np.array(vector)
+    vector.flags.writeable = False
+    QUERY_CACHE.put((name, c_text), vector)
+    return vector
+
 class SpacyEmbeddings:
     NAME = 'SpacyEmbeddings'
     NUM_DIMENSIONS = 200
+    BATCH_SIZE = 64
 
     @classmethod
     def init(cls):
@@ -21,9 +34,9 @@ class SpacyEmbeddings:
         for k in sections_vector.keys():
             if sections_vector[k] is None:
                 continue
-            vector = sections_vector[k]['vector']
-            accum_vector += vector
+            # Section vectors are means over their tokens
             num_elements = sections_vector[k]['num_elements']
+            accum_vector += sections_vector[k]['vector'] * num_elements
             num_total_elements += num_elements
 
         if num_total_elements > 0:
@@ -46,9 +59,8 @@ class SpacyEmbeddings:
             if fix_section == section:
                 if sections_vector[k] is None:
                     continue
-                vector = sections_vector[k]['vector']
-                accum_vector += vector
                 num_elements = sections_vector[k]['num_elements']
+                accum_vector += sections_vector[k]['vector'] * num_elements
                 num_total_elements += num_elements
 
         if num_total_elements > 0:
@@ -75,12 +87,29 @@ class SpacyEmbeddings:
 
     @classmethod
     def compute_mean_vector_from_text(cls, text):
-        c_text = clean_text(text)
+        with METRICS.timer('coronagle_stage_seconds', stage='clean', method=cls.NAME):
+            c_text = clean_text(text)
         if c_text is None:
             return None
 
-        doc_spacy = cls.NLP(c_text)
-        return doc_spacy.vector
+        vector = QUERY_CACHE.get((cls.NAME, c_text))
+        if vector is None:
+            with METRICS.timer('coronagle_stage_seconds', stage='inference', method=cls.NAME):
+                doc_spacy = cls.NLP(c_text)
+            vector = cache_query_vector(cls.NAME, c_text, doc_spacy.vector)
+        return vector
+
+    @classmethod
+    def compute_mean_vectors_from_texts(cls, texts):
+        with METRICS.timer('coronagle_stage_seconds', stage='clean', method=cls.NAME):
+            c_texts = [clean_text(text) for text in texts]
+        vectors = [QUERY_CACHE.get((cls.NAME, c_text)) if c_text is not None else None for c_text in c_texts]
+        missing = [i for i, c_text in enumerate(c_texts) if c_text is not None and vectors[i] is None]
+
+        with METRICS.timer('coronagle_stage_seconds', stage='inference', method=cls.NAME):
+            for i, doc_spacy in zip(missing, cls.NLP.pipe([c_texts[i] for i in missing], batch_size=cls.BATCH_SIZE)):
+                vectors[i] = cache_query_vector(cls.NAME, c_texts[i], doc_spacy.vector)
+        return vectors
 
 Database.register_method(SpacyEmbeddings)
 
@@ -103,6 +132,7 @@ class FlairEmbeddings:
         cls.FLAIR_EMB = FlairEmbeddings__('en-forward-fast')
         cls.NUM_DIMENSIONS = cls.FLAIR_EMB.embedding_length
         cls.BATCH_SIZE = 3
+        cls.QUERY_BATCH_SIZE = 32
         cls.FLAIR = flair
         flair.embedding_storage_mode = None
 
@@ -114,9 +144,9 @@ class FlairEmbeddings:
         for k in sections_vector.keys():
             if sections_vector[k] is None:
                 continue
-            vector = sections_vector[k]['vector']
-            accum_vector += vector
+            # Section vectors are means over their tokens
             num_elements = sections_vector[k]['num_elements']
+            accum_vector += sections_vector[k]['vector'] * num_elements
             num_total_elements += num_elements
 
         if num_total_elements > 0:
@@ -139,9 +169,8 @@ class FlairEmbeddings:
             if fix_section == section:
                 if sections_vector[k] is None:
                     continue
-                vector = sections_vector[k]['vector']
-                accum_vector += vector
                 num_elements = sections_vector[k]['num_elements']
+                accum_vector += sections_vector[k]['vector'] * num_elements
                 num_total_elements += num_elements
 
         if num_total_elements > 0:
@@ -185,17 +214,40 @@ class FlairEmbeddings:
 
     @classmethod
     def compute_mean_vector_from_text(cls, text):
-        c_text = clean_text(text)
+        with METRICS.timer('coronagle_stage_seconds', stage='clean', method=cls.NAME):
+            c_text = clean_text(text)
         if c_text is None:
             return None
 
-        sentence = cls.SENTENCE(c_text)
-        cls.FLAIR_EMB.embed(sentence)
-        mean_vector = np.mean([token.embedding.cpu().numpy() for token in sentence], axis=0)
-        sentence.clear_embeddings()
+        mean_vector = QUERY_CACHE.get((cls.NAME, c_text))
+        if mean_vector is None:
+            with METRICS.timer('coronagle_stage_seconds', stage='inference', method=cls.NAME):
+                sentence = cls.SENTENCE(c_text)
+                cls.FLAIR_EMB.embed(sentence)
+                mean_vector = np.mean([token.embedding.cpu().numpy() for token in sentence], axis=0)
+                sentence.clear_embeddings()
+            mean_vector = cache_query_vector(cls.NAME, c_text, mean_vector)
 
         return mean_vector
 
+    @classmethod
+    def compute_mean_vectors_from_texts(cls, texts):
+        with METRICS.timer('coronagle_stage_seconds', stage='clean', method=cls.NAME):
+            c_texts = [clean_text(text) for text in texts]
+        vectors = [QUERY_CACHE.get((cls.NAME, c_text)) if c_text else None for c_text in c_texts]
+        missing = [i for i, c_text in enumerate(c_texts) if c_text and vectors[i] is None]
+        sentences = [cls.SENTENCE(c_texts[i]) for i in missing]
+
+        with METRICS.timer('coronagle_stage_seconds', stage='inference', method=cls.NAME):
+            for i in range(0, len(sentences), cls.QUERY_BATCH_SIZE):
+                cls.FLAIR_EMB.embed(sentences[i:i+cls.QUERY_BATCH_SIZE])
+
+        for i, sentence in zip(missing, sentences):
+            mean_vector = np.mean([token.embedding.cpu().numpy() for token in sentence], axis=0)
+            sentence.clear_embeddings()
+            vectors[i] = cache_query_vector(cls.NAME, c_texts[i], mean_vector)
+        return vectors
+
 Database.register_method(FlairEmbeddings)
 
 # class Word2Vec:
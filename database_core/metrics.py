@@ -0,0 +1,157 @@
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, Thread
+import bisect
+import time
+import sys
+import os
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+class Metrics:
+    """
+        Thread-safe latency histograms, counters and gauges rendered in the Prometheus text format
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.help = {}
+        # name -> labels -> [bucket counts..., +Inf count], sum
+        self.histograms = defaultdict(dict)
+        self.counters = defaultdict(lambda: defaultdict(float))
+        self.gauges = {}
+        self.counter_funcs = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def observe(self, name, value, **labels):
+        labels = tuple(sorted(labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms[name].get(labels, None)
+            if histogram is None:
+                histogram = self.histograms[name][labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][position] += 1
+            histogram[1] += value
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name][tuple(sorted(labels.items()))] += value
+
+    def gauge(self, name, func):
+        """
+            func: () -> {labels dict as tuple of (k, v): value}, evaluated at every render
+        """
+        self.gauges[name] = func
+
+    def counter(self, name, func):
+        """
+            Like gauge, for counts kept elsewhere that only go up (e.g. cache hits), rendered as a counter
+        """
+        self.counter_funcs[name] = func
+
+    @contextmanager
+    def timer(self, name, **labels):
+        a0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - a0, **labels)
+
+    def timed(self, name, **labels):
+        def wrapper(func):
+            @wraps(func)
+            def decorator(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return decorator
+        return wrapper
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, histograms in self.histograms.items():
+                lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+                for labels, (counts, total) in histograms.items():
+                    accum = 0
+                    for bucket, count in zip(self.buckets + ('+Inf', ), counts):
+                        accum += count
+                        lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bucket), )), accum))
+                    lines.append('%s_sum%s %.6f' % (name, format_labels(labels), total))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), accum))
+
+            for name, counters in self.counters.items():
+                lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in counters.items():
+                    lines.append('%s%s %g' % (name, format_labels(labels), value))
+
+        for metric_type, funcs in [('gauge', self.gauges), ('counter', self.counter_funcs)]:
+            for name, func in list(funcs.items()):
+                lines.append('# HELP %s %s' % (name, self.help.get(name, name)))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                for labels, value in func().items():
+                    lines.append('%s%s %g' % (name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+class SamplingProfiler:
+    """
+        Samples the stack of every thread each interval seconds, stacks are counted in the
+        collapsed format (frame;frame;frame count) read by flamegraph.pl / speedscope
+    """
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self.lock = Lock()
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            samples = []
+            for thread_id, frame in sys._current_frames().items():
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                # The sampler itself is not interesting
+                if len(stack) > 0 and stack[0].startswith('metrics.py:run:'):
+                    continue
+                samples.append(';'.join(reversed(stack)))
+
+            with self.lock:
+                self.stacks.update(samples)
+
+    def render(self, top=None):
+        with self.lock:
+            stacks = self.stacks.most_common(top)
+        return '\n'.join('%s %d' % (stack, count) for stack, count in stacks) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+
+METRICS = Metrics()
+METRICS.describe('coronagle_stage_seconds', 'Latency of every stage of a search request')
+METRICS.describe('coronagle_request_seconds', 'Latency of every request, by endpoint and status')
+METRICS.describe('coronagle_ingestion_seconds', 'Latency of the ingestion and embedding stages')
+METRICS.describe('coronagle_documents_total', 'Documents processed by every ingestion and embedding stage')
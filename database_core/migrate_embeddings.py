@@ -0,0 +1,10 @@
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from database_core import *
+
+# Pickled section vectors -> binary encoding (Params.EMBEDDINGS_DTYPE), then the missing
+# document vectors (doc_vectors) from the section ones and the missing result snippets. Safe to run again
+methods = sys.argv[1:] if len(sys.argv) > 1 else None
+print('UPDATED', Database.migrate_embeddings(methods=methods), 'documents')
+print('UPDATED', Database.update_doc_vectors(methods=methods), 'document vectors')
+print('UPDATED', Database.update_snippets(), 'snippets')
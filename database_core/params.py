@@ -13,11 +13,61 @@ mongo_data = dict(
 
 class Params:
 	DB_URL = 'mongodb://{user}:{passwd}@{ip}:{port}'.format(**mongo_data)
-	DB_NAME = "coronagle_db"
+	DB_NAME = os.getenv('MONGO_DB_NAME', "coronagle_db")
+	DB_IN_PROCESS = os.getenv('MONGO_IN_PROCESS', '0') == '1'
 
 	DATASET_KAGGLE_NAME = 'allen-institute-for-ai/CORD-19-research-challenge'
 	DATASET_KAGGLE_RAW = os.path.join(os.path.dirname(os.path.abspath(__file__)), "raw")
+	SYNC_INTERVAL_HOURS = int(os.getenv('SYNC_INTERVAL_HOURS', 1))
+	# Pre-populated local dataset folder synced instead of the Kaggle download, and whether app.py runs the sync pipeline
+	SYNC_FOLDER = os.getenv('SYNC_FOLDER', None)
+	SYNC_IN_APP = os.getenv('SYNC_IN_APP', '0') == '1'
+	# Only the process holding the sync lease (renewed while it runs) syncs, the others take over once it expires
+	SYNC_LEASE_SECONDS = int(os.getenv('SYNC_LEASE_SECONDS', 600))
+	INDEXES_PATH = os.getenv('INDEXES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes"))
+	# Flat file embeddings shared (memmap) by every server worker, written by export_embeddings.py
+	EMBEDDINGS_STORE_PATH = os.getenv('EMBEDDINGS_STORE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), "embeddings"))
 
-	SCAN_WORKERS = 8
+	SEARCH_SECTIONS = ['abstract', 'method', 'results', 'conclusions']
+	RERANK_CANDIDATES = 2000
+	FUSION_WORKERS = int(os.getenv('FUSION_WORKERS', 8))
+	FUSION_RRF_K = 60
+	# Extra SearchEngine arguments per method, e.g. {'FlairEmbeddings': {'pca_dimensions': 256, 'index_spec': 'IVF{num_centroids},PQ32'}}
+	ENGINES_PARAMS = {}
+
+	SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', os.cpu_count() or 8))
+	INSERT_BATCH_SIZE = int(os.getenv('INSERT_BATCH_SIZE', 500))
+	# Sync pipeline (scan -> clean -> embed, one stage per method -> index), bounded queues between stages
+	PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 2000))
+	PIPELINE_WORKERS = {'clean': 2, 'embed': 1, 'index': 1}
+	PIPELINE_BATCH_SIZE = {'clean': 100, 'embed': 200, 'index': 1000}
+	# Failed batches are retried after PIPELINE_RETRY_DELAY * attempt seconds, then left for the next sync
+	PIPELINE_RETRIES = int(os.getenv('PIPELINE_RETRIES', 2))
+	PIPELINE_RETRY_DELAY = float(os.getenv('PIPELINE_RETRY_DELAY', 5))
 	COMPUTE_VECTORS_WORKERS = 8
 	READ_EMBEDDINGS_WORKERS = 12
+	CURSOR_BATCH_SIZE = int(os.getenv('CURSOR_BATCH_SIZE', 1000))
+	EMBEDDINGS_WRITE_BATCH = int(os.getenv('EMBEDDINGS_WRITE_BATCH', 500))
+	EMBEDDINGS_PAGE_SIZE = int(os.getenv('EMBEDDINGS_PAGE_SIZE', 2000))
+	# Stored section vectors: 'float32' or 'float16' (half the size, ~3 significant digits)
+	EMBEDDINGS_DTYPE = os.getenv('EMBEDDINGS_DTYPE', 'float32')
+	# Pickled vectors written by older versions are still read until migrate_embeddings.py runs
+	EMBEDDINGS_LEGACY_PICKLE = os.getenv('EMBEDDINGS_LEGACY_PICKLE', '1') == '1'
+
+	QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 4096))
+	QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', 24 * 3600))
+	RESULTS_CACHE_SIZE = int(os.getenv('RESULTS_CACHE_SIZE', 2048))
+	RESULTS_CACHE_TTL = float(os.getenv('RESULTS_CACHE_TTL', 3600))
+	# Result page fields (title, abstract, snippet) of hot papers, bounded by (estimated) bytes. Updates only
+	# invalidate the cache of the process writing them (the sync), other workers see them after the TTL
+	DOCUMENTS_CACHE_BYTES = int(os.getenv('DOCUMENTS_CACHE_BYTES', 256 * 1024 * 1024))
+	DOCUMENTS_CACHE_TTL = float(os.getenv('DOCUMENTS_CACHE_TTL', 600))
+
+	SNIPPET_LENGTH = 400
+	GZIP_RESPONSES = os.getenv('GZIP_RESPONSES', '1') == '1'
+	GZIP_MIN_SIZE = 1024
+	GZIP_LEVEL = 5
+
+	# Sampling profiler of every thread, served on /profile (collapsed stacks)
+	PROFILE_SAMPLING = os.getenv('PROFILE_SAMPLING', '0') == '1'
+	PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
@@ -0,0 +1,141 @@
+from threading import Thread, Lock
+import traceback
+import queue
+import time
+
+from . import Params
+from . import METRICS
+
+METRICS.describe('coronagle_pipeline_seconds', 'Latency of every batch processed by a pipeline stage')
+METRICS.describe('coronagle_pipeline_items_total', 'Items processed by every pipeline stage (emitted by the source)')
+METRICS.describe('coronagle_pipeline_errors_total', 'Batch attempts that raised in every pipeline stage')
+METRICS.describe('coronagle_pipeline_queue_size', 'Items waiting in the input queue of every pipeline stage')
+
+# End of an input, and the signal a finished worker leaves to its siblings
+STOP = object()
+EXIT = object()
+
+class Stage:
+    """
+        func(list of items) -> list of output items (or None), called by num_workers threads with
+        batches of up to batch_size items (whatever is queued, never waiting to fill a batch)
+        The input queue is bounded (queue_size), a slow stage blocks the ones feeding it
+        A batch that raises is retried (retries, Params.PIPELINE_RETRIES) before it is dropped,
+        on_drop(list of items) is then called with it
+    """
+    def __init__(self, name, func, num_workers=1, batch_size=1, queue_size=None, retries=None, on_drop=None):
+        self.name = name
+        self.func = func
+        self.on_drop = on_drop
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.retries = Params.PIPELINE_RETRIES if retries is None else retries
+        self.queue = queue.Queue(maxsize=Params.PIPELINE_QUEUE_SIZE if queue_size is None else queue_size)
+        self.outputs = []
+        self.num_inputs = 0
+        self.num_stopped = 0
+        self.num_alive = 0
+        self.lock = Lock()
+        self.threads = []
+
+    def connect(self, *stages):
+        for stage in stages:
+            self.outputs.append(stage)
+            stage.num_inputs += 1
+        return self
+
+    def emit(self, items):
+        for item in items:
+            for stage in self.outputs:
+                stage.queue.put(item)
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not STOP and batch[-1] is not EXIT:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def process(self, batch):
+        for attempt in range(self.retries + 1):
+            a0 = time.perf_counter()
+            try:
+                outputs = self.func(batch)
+                break
+            except Exception:
+                traceback.print_exc()
+                METRICS.inc('coronagle_pipeline_errors_total', stage=self.name)
+                if attempt == self.retries:
+                    if self.on_drop is not None:
+                        self.on_drop(batch)
+                    return
+            finally:
+                METRICS.observe('coronagle_pipeline_seconds', time.perf_counter() - a0, stage=self.name)
+            # Retried in place, putting the batch back could block on the stage's own full queue
+            time.sleep(Params.PIPELINE_RETRY_DELAY * (attempt + 1))
+        METRICS.inc('coronagle_pipeline_items_total', value=len(batch), stage=self.name)
+        self.emit(outputs if outputs is not None else [])
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            signal = batch.pop() if batch[-1] is STOP or batch[-1] is EXIT else None
+            if len(batch) > 0:
+                self.process(batch)
+
+            if signal is STOP:
+                with self.lock:
+                    self.num_stopped += 1
+                    if self.num_stopped < self.num_inputs:
+                        continue
+                # Every input is done (nothing else can be queued), the siblings can exit too
+                for _ in range(self.num_workers - 1):
+                    self.queue.put(EXIT)
+            if signal is not None:
+                break
+
+        with self.lock:
+            self.num_alive -= 1
+            is_last = self.num_alive == 0
+        if is_last:
+            for stage in self.outputs:
+                stage.queue.put(STOP)
+
+    def start(self):
+        self.num_alive = self.num_workers
+        self.threads = [Thread(target=self.run, name='%s-%d' % (self.name, i), daemon=True) for i in range(self.num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+class Pipeline:
+    """
+        source(emit) produces the items of the first stages (emit(list of items)), every stage
+        runs concurrently with the others, so items flow through as soon as they are produced
+    """
+    def __init__(self, source, first_stages, stages, source_name='source'):
+        self.source_stage = Stage(source_name, None)
+        self.source_stage.connect(*first_stages)
+        self.source = source
+        self.stages = stages
+        METRICS.gauge('coronagle_pipeline_queue_size', lambda: {(('stage', stage.name), ): stage.queue.qsize() for stage in self.stages})
+
+    def run(self):
+        """
+            Blocks until the source returns and every stage has drained
+        """
+        for stage in self.stages:
+            stage.start()
+        def emit(items):
+            self.source_stage.emit(items)
+            METRICS.inc('coronagle_pipeline_items_total', value=len(items), stage=self.source_stage.name)
+
+        try:
+            self.source(emit)
+        finally:
+            for stage in self.source_stage.outputs:
+                stage.queue.put(STOP)
+            for stage in self.stages:
+                for thread in stage.threads:
+                    thread.join()
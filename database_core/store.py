@@ -0,0 +1,131 @@
+import numpy as np
+import json
+import time
+import os
+
+from . import Params
+from . import Database
+
+class EmbeddingsStore:
+    """
+        Flat file export of the document embeddings, one folder per engine:
+            <name>/vectors.<version>.npy      float32 (num_docs, num_dimensions), C order
+            <name>/hash_ids.<version>.json    row -> hash_id
+            <name>/current.json               {'version', 'embeddings_version', ...}, replaced last
+        Server workers open the vectors with np.load(mmap_mode='r'), every process shares
+        the same page cache instead of holding its own copy. Only export reads MongoDB.
+        embeddings_version is the Database.embeddings_version of the method when it was exported
+    """
+    DOCUMENTS = 'documents'
+
+    def folder(name, path=None):
+        return os.path.join(Params.EMBEDDINGS_STORE_PATH if path is None else path, name)
+
+    def read_current(name, path=None):
+        current_path = os.path.join(EmbeddingsStore.folder(name, path), 'current.json')
+        if not os.path.isfile(current_path):
+            return None
+        with open(current_path, 'r') as current_file:
+            return json.load(current_file)
+
+    def write(name, hash_ids, matrix, version, path=None, embeddings_version=None):
+        """
+            Writes a new version of name and publishes it. The previous version is kept for
+            readers that read current.json before it was replaced, older ones are deleted
+            (readers that mapped them keep their mapping, unlinked files live while mapped)
+        """
+        folder = EmbeddingsStore.folder(name, path)
+        os.makedirs(folder, exist_ok=True)
+        previous = EmbeddingsStore.read_current(name, path)
+
+        if matrix is not None:
+            with open(os.path.join(folder, 'vectors.%s.npy' % version), 'wb') as vectors_file:
+                np.save(vectors_file, np.ascontiguousarray(matrix, dtype=np.float32))
+        with open(os.path.join(folder, 'hash_ids.%s.json' % version), 'w') as hash_ids_file:
+            json.dump(list(hash_ids), hash_ids_file)
+
+        current = {
+            'version': version,
+            'num_docs': len(hash_ids),
+            'num_dimensions': int(matrix.shape[1]) if matrix is not None else None,
+            'embeddings_version': embeddings_version
+        }
+        with open(os.path.join(folder, 'current.json.tmp'), 'w') as current_file:
+            json.dump(current, current_file)
+        os.replace(os.path.join(folder, 'current.json.tmp'), os.path.join(folder, 'current.json'))
+
+        keep = {version} | ({previous['version']} if previous is not None else set())
+        for file_name in os.listdir(folder):
+            parts = file_name.split('.')
+            if len(parts) == 3 and parts[0] in ('vectors', 'hash_ids') and parts[1] not in keep:
+                os.remove(os.path.join(folder, file_name))
+
+    def load(name, path=None, embeddings_version=None):
+        """
+            returns (hash_ids, read-only memmapped matrix), or None when name was never exported
+            or, given embeddings_version, was exported at another one (stale)
+        """
+        # A version deleted between reading current.json and its files (two exports meanwhile)
+        for attempt in range(3):
+            try:
+                return EmbeddingsStore.load_current(name, path, embeddings_version)
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def load_current(name, path=None, embeddings_version=None):
+        current = EmbeddingsStore.read_current(name, path)
+        if current is None:
+            return None
+        if embeddings_version is not None and current.get('embeddings_version', None) != embeddings_version:
+            print('STALE EXPORT', name, current.get('embeddings_version', None), embeddings_version)
+            return None
+
+        folder = EmbeddingsStore.folder(name, path)
+        with open(os.path.join(folder, 'hash_ids.%s.json' % current['version']), 'r') as hash_ids_file:
+            hash_ids = json.load(hash_ids_file)
+        if current['num_dimensions'] is None:
+            return hash_ids, None
+        return hash_ids, np.load(os.path.join(folder, 'vectors.%s.npy' % current['version']), mmap_mode='r')
+
+    def load_hash_ids(path=None):
+        output = EmbeddingsStore.load(EmbeddingsStore.DOCUMENTS, path)
+        return output[0] if output is not None else None
+
+    def to_matrix(method_obj, doc_embeddings):
+        hash_ids = []
+        vectors = []
+        for doc in doc_embeddings:
+            if doc['vector'] is None or np.prod(doc['vector'].shape) == 0:
+                continue
+            hash_ids.append(doc['hash_id'])
+            vectors.append(doc['vector'])
+
+        if len(vectors) == 0:
+            return hash_ids, np.zeros(shape=(0, method_obj.NUM_DIMENSIONS), dtype=np.float32)
+        return hash_ids, np.stack(vectors, axis=0).astype(np.float32)
+
+    def export(methods=None, sections=None, path=None):
+        """
+            Dumps every method (and its sections, named '<method>.<section>') from MongoDB
+        """
+        methods = Database.list_methods() if methods is None else methods
+        sections = Params.SEARCH_SECTIONS if sections is None else sections
+        version = '%d' % (time.time() * 1000)
+
+        EmbeddingsStore.write(EmbeddingsStore.DOCUMENTS, Database.list_hash_ids(), None, version, path)
+        for method in methods:
+            method_obj = Database.get_method(method)
+            a0 = time.time()
+            # Read before the dump, embeddings written meanwhile leave the export stale
+            embeddings_version = Database.embeddings_version(method)
+            hash_ids, matrix = EmbeddingsStore.to_matrix(method_obj, Database.iter_doc_embeddings(method))
+            EmbeddingsStore.write(method, hash_ids, matrix, version, path, embeddings_version)
+            del matrix
+
+            section_embeddings = Database.list_doc_embeddings_from_sections(method, sections, use_translation=True)
+            for section in sections:
+                hash_ids, matrix = EmbeddingsStore.to_matrix(method_obj, section_embeddings.pop(section))
+                EmbeddingsStore.write('%s.%s' % (method, section), hash_ids, matrix, version, path, embeddings_version)
+                del matrix
+            print('EXPORTED', method, '%.2fs' % (time.time() - a0))
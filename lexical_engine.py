@@ -0,0 +1,300 @@
+import numpy as np
+import pickle
+import hashlib
+from collections import Counter
+
+import os
+
+class BM25Engine:
+    NAME = 'BM25'
+    INDEX_VERSION = 1
+    BLOCK_SIZE = 128
+    # Postings buffered as python lists before they are packed into numpy arrays
+    CHUNK_POSTINGS = 1 << 20
+
+    """
+    ==============================================================================
+        INDEXING
+    ==============================================================================
+    """
+    def create_index(self, doc_tokens):
+        """
+            doc_tokens is consumed once (it can be a generator), the postings are packed into
+            numpy chunks as they come instead of python lists of the whole collection
+        """
+        vocabulary = {}
+        doc_hash_id = []
+        doc_lengths = []
+        triplets_term, triplets_doc, triplets_tf = [], [], []
+        chunks_term, chunks_doc, chunks_tf = [], [], []
+        def pack():
+            chunks_term.append(np.array(triplets_term, dtype=np.int32))
+            chunks_doc.append(np.array(triplets_doc, dtype=np.int32))
+            chunks_tf.append(np.array(triplets_tf, dtype=np.float32))
+            del triplets_term[:], triplets_doc[:], triplets_tf[:]
+
+        for doc in doc_tokens:
+            if doc['tokens'] is None or len(doc['tokens']) == 0:
+                continue
+
+            doc_id = len(doc_hash_id)
+            doc_hash_id.append(doc['hash_id'])
+            doc_lengths.append(len(doc['tokens']))
+            for token, tf in Counter(doc['tokens']).items():
+                triplets_term.append(vocabulary.setdefault(token, len(vocabulary)))
+                triplets_doc.append(doc_id)
+                triplets_tf.append(tf)
+            if len(triplets_term) >= BM25Engine.CHUNK_POSTINGS:
+                pack()
+        pack()
+
+        self.vocabulary = vocabulary
+        self.doc_hash_id = np.array(doc_hash_id, dtype=object)
+        num_docs = len(doc_hash_id)
+        doc_lengths = np.array(doc_lengths, dtype=np.float32)
+        terms = np.concatenate(chunks_term)
+        docs = np.concatenate(chunks_doc)
+        tfs = np.concatenate(chunks_tf)
+        del chunks_term, chunks_doc, chunks_tf
+
+        # CSR postings: docs of a term are contiguous and sorted (stable sort keeps doc order)
+        order = np.argsort(terms, kind='stable')
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        df = np.bincount(terms, minlength=len(vocabulary))
+        self.term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        self.term_offsets[1:] = np.cumsum(df)
+
+        # Impacts are precomputed, a query is just a sum of them
+        avg_length = doc_lengths.mean() if num_docs > 0 else 0.0
+        idf = np.log(1 + (num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = self.k1 * (1 - self.b + self.b * doc_lengths[docs] / max(avg_length, 1e-6))
+        self.postings_docs = docs
+        self.postings_impacts = (idf[terms] * tfs * (self.k1 + 1) / (tfs + norm)).astype(np.float32)
+        self.create_blocks()
+
+    def create_blocks(self):
+        # Fixed size blocks inside every term postings, with their first / last doc and max impact
+        num_blocks = (np.diff(self.term_offsets) + BM25Engine.BLOCK_SIZE - 1) // BM25Engine.BLOCK_SIZE
+        self.term_blocks = np.zeros(len(num_blocks) + 1, dtype=np.int64)
+        self.term_blocks[1:] = np.cumsum(num_blocks)
+
+        block_term = np.repeat(np.arange(len(num_blocks)), num_blocks)
+        block_rank = np.arange(self.term_blocks[-1]) - self.term_blocks[block_term]
+        self.block_starts = self.term_offsets[block_term] + block_rank * BM25Engine.BLOCK_SIZE
+        self.block_ends = np.minimum(self.block_starts + BM25Engine.BLOCK_SIZE, self.term_offsets[block_term + 1])
+        if len(self.block_starts) > 0:
+            self.block_max = np.maximum.reduceat(self.postings_impacts, self.block_starts)
+            self.term_max = np.maximum.reduceat(self.block_max, self.term_blocks[:-1])
+        else:
+            self.block_max = np.zeros(0, dtype=np.float32)
+            self.term_max = np.zeros(0, dtype=np.float32)
+        self.block_first_doc = self.postings_docs[self.block_starts]
+        self.block_last_doc = self.postings_docs[self.block_ends - 1]
+
+    def __init__(self, doc_tokens, tokenize, k1=1.2, b=0.75):
+        """
+            doc_tokens: iterable of {'hash_id', 'tokens'}
+            tokenize: text -> list of tokens, must match the one used for doc_tokens
+        """
+        self.tokenize = tokenize
+        self.k1 = k1
+        self.b = b
+        self.section_engines = {}
+        if doc_tokens is not None:
+            self.create_index(doc_tokens)
+
+    """
+    ==============================================================================
+        PERSISTENCE
+    ==============================================================================
+    """
+    @staticmethod
+    def compute_fingerprint(sources_hashes):
+        """
+            sources_hashes: iterable of (hash_id, content hash), changes with the set of documents and their contents
+        """
+        sha = hashlib.sha1()
+        sha.update(('%d;' % BM25Engine.INDEX_VERSION).encode('utf-8'))
+        sha.update('\n'.join('%s:%s' % (hash_id, source_hash) for hash_id, source_hash in sorted(sources_hashes)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def save(self, folder, fingerprint):
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'postings.npz.tmp'), 'wb') as postings_file:
+            np.savez(postings_file, term_offsets=self.term_offsets, postings_docs=self.postings_docs, postings_impacts=self.postings_impacts)
+        os.replace(os.path.join(folder, 'postings.npz.tmp'), os.path.join(folder, 'postings.npz'))
+
+        meta = {
+            'version': BM25Engine.INDEX_VERSION,
+            'fingerprint': fingerprint,
+            'k1': self.k1,
+            'b': self.b,
+            'vocabulary': self.vocabulary,
+            'hash_ids': self.doc_hash_id.tolist()
+        }
+        with open(os.path.join(folder, 'meta.pkl.tmp'), 'wb') as meta_file:
+            pickle.dump(meta, meta_file, protocol=4)
+        os.replace(os.path.join(folder, 'meta.pkl.tmp'), os.path.join(folder, 'meta.pkl'))
+
+    @staticmethod
+    def load(folder, fingerprint, tokenize):
+        meta_path = os.path.join(folder, 'meta.pkl')
+        postings_path = os.path.join(folder, 'postings.npz')
+        if not os.path.isfile(meta_path) or not os.path.isfile(postings_path):
+            return None
+
+        with open(meta_path, 'rb') as meta_file:
+            meta = pickle.load(meta_file)
+        if meta['version'] != BM25Engine.INDEX_VERSION or meta['fingerprint'] != fingerprint:
+            return None
+
+        engine = BM25Engine(None, tokenize, k1=meta['k1'], b=meta['b'])
+        engine.vocabulary = meta['vocabulary']
+        engine.doc_hash_id = np.array(meta['hash_ids'], dtype=object)
+        with np.load(postings_path) as postings:
+            engine.term_offsets = postings['term_offsets']
+            engine.postings_docs = postings['postings_docs']
+            engine.postings_impacts = postings['postings_impacts']
+        engine.create_blocks()
+        return engine
+
+    @staticmethod
+    def load_or_create(folder, sources_hashes, list_doc_tokens, tokenize):
+        """
+            Rebuilds (calling list_doc_tokens) only when the documents or their contents changed
+            sources_hashes: (hash_id, content hash) of the documents list_doc_tokens reads
+        """
+        fingerprint = BM25Engine.compute_fingerprint(sources_hashes)
+        engine = BM25Engine.load(folder, fingerprint, tokenize)
+        if engine is None:
+            engine = BM25Engine(list_doc_tokens(), tokenize)
+            engine.save(folder, fingerprint)
+        return engine
+
+    """
+    ==============================================================================
+        SEARCH
+    ==============================================================================
+    """
+    @staticmethod
+    def expand_ranges(starts, ends):
+        lengths = ends - starts
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    def search_tokens(self, tokens, k=10):
+        """
+            BM25 top-k (exact up to ties at the threshold) with block-max MaxScore: terms go
+            from rarest to most common, and once the remaining ones can not lift a new document
+            into the top-k only the current candidates are scored, in the blocks that matter
+        """
+        terms = np.array(sorted({self.vocabulary[token] for token in tokens if token in self.vocabulary}), dtype=np.int64)
+        num_docs = len(self.doc_hash_id)
+        if len(terms) == 0 or k <= 0:
+            return []
+        k = min(k, num_docs)
+
+        terms = terms[np.argsort(-self.term_max[terms])]
+        remaining_upper = np.concatenate([np.cumsum(self.term_max[terms][::-1])[::-1][1:], [0]])
+
+        scores = np.zeros(num_docs, dtype=np.float32)
+        touched = np.zeros(0, dtype=self.postings_docs.dtype)
+        threshold = 0
+        candidates = None
+        for term, upper_after in zip(terms, remaining_upper):
+            if candidates is None:
+                # Essential term, score the whole postings list (docs are unique inside it)
+                start, end = self.term_offsets[term], self.term_offsets[term + 1]
+                scores[self.postings_docs[start:end]] += self.postings_impacts[start:end]
+
+                # Only touched documents have a score, the threshold never needs a full scan
+                touched = np.union1d(touched, self.postings_docs[start:end])
+                if len(touched) >= k:
+                    threshold = np.partition(scores[touched], len(touched) - k)[len(touched) - k]
+                if threshold > 0 and upper_after <= threshold:
+                    candidates = touched[scores[touched] + upper_after > threshold]
+                continue
+
+            if len(candidates) == 0:
+                break
+
+            # Blocks of this term holding at least one candidate
+            blocks = np.arange(self.term_blocks[term], self.term_blocks[term + 1])
+            low = np.searchsorted(candidates, self.block_first_doc[blocks], side='left')
+            high = np.searchsorted(candidates, self.block_last_doc[blocks], side='right')
+            has_candidates = high > low
+            blocks, low, high = blocks[has_candidates], low[has_candidates], high[has_candidates]
+            if len(blocks) == 0:
+                continue
+
+            # Block-max: skip blocks where even the best candidate can not pass the threshold
+            # (reduceat segments may span candidates between blocks, an over-estimate is still safe)
+            best_in_block = np.maximum.reduceat(scores[candidates], low)
+            keep = best_in_block + self.block_max[blocks] + upper_after > threshold
+            blocks = blocks[keep]
+            if len(blocks) == 0:
+                continue
+
+            positions = BM25Engine.expand_ranges(self.block_starts[blocks], self.block_ends[blocks])
+            docs = self.postings_docs[positions]
+            found = np.searchsorted(candidates, docs)
+            is_candidate = candidates[np.minimum(found, len(candidates) - 1)] == docs
+            scores[docs[is_candidate]] += self.postings_impacts[positions[is_candidate]]
+
+            if len(candidates) >= k:
+                threshold = max(threshold, np.partition(scores[candidates], len(candidates) - k)[len(candidates) - k])
+            candidates = candidates[scores[candidates] + upper_after > threshold]
+
+        # Every scored document is in touched, candidates are a subset of it
+        k = min(k, len(touched))
+        top = touched[np.argpartition(-scores[touched], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return self.doc_hash_id[top[scores[top] > 0]].tolist()
+
+    def get_similar_docs_than(self, text, k=10, section=None):
+        if section is not None:
+            raise KeyError(section)
+
+        tokens = self.tokenize(text)
+        if tokens is None:
+            return []
+        return self.search_tokens(tokens, k=k)
+
+    def search_batch(self, texts, k=10, section=None):
+        return [self.get_similar_docs_than(text, k=k, section=section) for text in texts]
+
+class RerankEngine:
+    """
+        BM25 candidates reranked by a vector SearchEngine (exact mode)
+    """
+    def __init__(self, lexical_engine, vector_engine, num_candidates=2000):
+        assert(not vector_engine.use_faiss)
+        self.lexical_engine = lexical_engine
+        self.vector_engine = vector_engine
+        self.method = vector_engine.method
+        self.num_candidates = num_candidates
+        self.section_engines = {}
+
+    def rerank(self, text, vector, k):
+        if vector is None:
+            return self.lexical_engine.get_similar_docs_than(text, k=k)
+
+        candidates = self.lexical_engine.get_similar_docs_than(text, k=self.num_candidates)
+        if len(candidates) == 0:
+            # No known terms, plain vector search
+            return self.vector_engine.search_vectors(np.expand_dims(vector, axis=0), k=k)[0]
+        return self.vector_engine.rerank_vector(vector, candidates, k=k)
+
+    def get_similar_docs_than(self, text, k=10, section=None):
+        if section is not None:
+            raise KeyError(section)
+        return self.rerank(text, self.method.compute_mean_vector_from_text(text), k)
+
+    def search_batch(self, texts, k=10, section=None):
+        if section is not None:
+            raise KeyError(section)
+
+        if hasattr(self.method, 'compute_mean_vectors_from_texts'):
+            vectors = self.method.compute_mean_vectors_from_texts(texts)
+        else:
+            vectors = [self.method.compute_mean_vector_from_text(text) for text in texts]
+        return [self.rerank(text, vector, k) for text, vector in zip(texts, vectors)]
@@ -1,8 +1,9 @@
-import faiss
 import numpy as np
 import pickle
+import hashlib
 from scipy.spatial import distance
 from functools import partial
+from threading import Thread, RLock
 
 import time
 import os
@@ -10,26 +11,29 @@ import glob
 import glob2
 import json
 
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+        rankings: list of ranked hash_id lists, returns the fused ranking (sum of 1 / (k + rank))
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, hash_id in enumerate(ranking):
+            scores[hash_id] = scores.get(hash_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.keys(), key=lambda hash_id: -scores[hash_id])
+
 class SearchEngine:
-    def search_preprocess(self, data, is_train=False):
+    INDEX_VERSION = 3
+
+    def search_preprocess(self, data):
         if self.faiss_params['preprocess_opt'] == 'norm':
             return np.float32((data + 1e-6) / (np.linalg.norm(data + 1e-6, keepdims=True, axis=-1) + 1e-30))
         elif self.faiss_params['preprocess_opt'] == 'false':
             return np.float32(data)
-        elif self.faiss_params['preprocess_opt'] == 'covar':
-            if is_train:
-                cov = np.np.cov(data)
-                L = np.linalg.cholesky(cov)
-                self.faiss_params['mahalanobis_transform'] = np.linalg.inv(L)
-            return np.float32(np.dot(data, self.faiss_params['mahalanobis_transform'].T))
-
-    def translate_distance_to_pdist(self, dist_name):
-        if dist_name == 'inner':
-            return lambda x, y: x.dot(y)
-        return dist_name
 
     def create_faiss(self):
-        quantiser = faiss.IndexFlatL2(self.num_dimensions)
+        # Lazy loading, the exact search does not need faiss at all
+        import faiss
+
         self.faiss_params = {}
         if self.similarity_metric == 'cosine':
             self.faiss_params['preprocess_opt'] = 'norm'
@@ -44,48 +48,516 @@ class SearchEngine:
             self.faiss_params['metric'] = faiss.METRIC_L2
 
         elif self.similarity_metric == 'mahalanobis':
-            self.faiss_params['preprocess_opt'] = 'covar'
+            # Vectors are already whitened, see fit_transform
+            self.faiss_params['preprocess_opt'] = 'false'
             self.faiss_params['metric'] = faiss.METRIC_L2
 
-        self.faiss_index = faiss.IndexIVFFlat(quantiser, self.num_dimensions, self.num_centroids, self.faiss_params['metric'])
-        vectors = self.search_preprocess(np.stack(self.doc_embeddings_vectors, axis=0), is_train=True)
+        # e.g. 'IVF{num_centroids},Flat', 'IVF{num_centroids},PQ16', 'IVF{num_centroids},SQ8', 'HNSW32', 'OPQ16,IVF{num_centroids},PQ16'
+        index_spec = self.index_spec.format(num_centroids=self.num_centroids)
+        self.faiss_index = faiss.index_factory(self.num_dimensions, index_spec, self.faiss_params['metric'])
+        try:
+            faiss.extract_index_ivf(self.faiss_index)
+        except RuntimeError:
+            # Only IVF indexes store ids, the rest need a map to support add / remove
+            self.faiss_index = faiss.IndexIDMap(self.faiss_index)
+
+        # The faiss ids are the positions in doc_embeddings_hash_id
+        vectors = self.search_preprocess(self.doc_embeddings_matrix)
         self.faiss_index.train(vectors)
-        self.faiss_index.add(vectors)
+        self.faiss_index.add_with_ids(vectors, np.arange(vectors.shape[0], dtype=np.int64))
+
+    def set_search_params(self, index=None):
+        import faiss
+
+        # nprobe, efSearch... only the ones the index understands are applied
+        parameter_space = faiss.ParameterSpace()
+        for name, value in self.search_params.items():
+            try:
+                parameter_space.set_index_parameter(self.faiss_index if index is None else index, name, value)
+            except RuntimeError:
+                pass
+
+    """
+    ==============================================================================
+        PERSISTENCE
+    ==============================================================================
+    """
+    def index_folder(self):
+        return os.path.join(self.index_path, self.name)
+
+    def compute_fingerprint(self, matrix):
+        """
+            matrix: raw document vectors, before any transform
+        """
+        sha = hashlib.sha1()
+        sha.update(('%d;%s;%s;%d;%s;%s;' % (SearchEngine.INDEX_VERSION, self.similarity_metric, self.index_spec, self.num_centroids, self.pca_dimensions, self.whiten)).encode('utf-8'))
+        sha.update('\n'.join(self.doc_embeddings_hash_id).encode('utf-8'))
+        for i in range(0, matrix.shape[0], 65536):
+            sha.update(np.ascontiguousarray(matrix[i:i+65536]).data)
+        return sha.hexdigest()
+
+    def save_transform(self, fingerprint):
+        folder = self.index_folder()
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'transform.pkl.tmp'), 'wb') as transform_file:
+            pickle.dump({'fingerprint': fingerprint, 'transform': self.transform}, transform_file, protocol=4)
+        os.replace(os.path.join(folder, 'transform.pkl.tmp'), os.path.join(folder, 'transform.pkl'))
+
+    def load_transform(self, fingerprint):
+        transform_path = os.path.join(self.index_folder(), 'transform.pkl')
+        if not os.path.isfile(transform_path):
+            return False
+
+        with open(transform_path, 'rb') as transform_file:
+            data = pickle.load(transform_file)
+        if data['fingerprint'] != fingerprint:
+            return False
+
+        self.transform = data['transform']
+        return True
+
+    def save_faiss(self, fingerprint):
+        import faiss
+
+        folder = self.index_folder()
+        os.makedirs(folder, exist_ok=True)
+        previous = self.read_faiss_meta()
+
+        # Write to temporary files and rename, a crashed save never leaves a half index behind
+        # One file per fingerprint, workers copy their index from the file they mapped (copy_faiss)
+        index_file = 'index.%s.faiss' % fingerprint
+        faiss.write_index(self.faiss_index, os.path.join(folder, index_file + '.tmp'))
+        os.replace(os.path.join(folder, index_file + '.tmp'), os.path.join(folder, index_file))
+
+        meta = {
+            'version': SearchEngine.INDEX_VERSION,
+            'fingerprint': fingerprint,
+            'index_file': index_file,
+            'similarity_metric': self.similarity_metric,
+            'index_spec': self.index_spec,
+            'num_centroids': self.num_centroids,
+            'faiss_params': self.faiss_params,
+            'hash_ids': self.doc_embeddings_hash_id.tolist()
+        }
+        with open(os.path.join(folder, 'meta.pkl.tmp'), 'wb') as meta_file:
+            pickle.dump(meta, meta_file, protocol=4)
+        os.replace(os.path.join(folder, 'meta.pkl.tmp'), os.path.join(folder, 'meta.pkl'))
+
+        # The previous index is kept for the workers still using it, older ones are deleted
+        keep = {index_file, previous.get('index_file', 'index.faiss') if previous is not None else None}
+        for file_name in os.listdir(folder):
+            if file_name.startswith('index.') and file_name.endswith('.faiss') and file_name not in keep:
+                os.remove(os.path.join(folder, file_name))
+
+    def read_faiss_meta(self):
+        meta_path = os.path.join(self.index_folder(), 'meta.pkl')
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path, 'rb') as meta_file:
+            return pickle.load(meta_file)
+
+    def load_faiss(self, fingerprint):
+        import faiss
+
+        meta = self.read_faiss_meta()
+        if meta is None or meta['version'] != SearchEngine.INDEX_VERSION or meta['fingerprint'] != fingerprint:
+            return False
+        index_path = os.path.join(self.index_folder(), meta.get('index_file', 'index.faiss'))
+        if not os.path.isfile(index_path):
+            return False
+
+        try:
+            # Inverted lists stay in the page cache, shared between workers
+            self.faiss_index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self.faiss_index_mmap_path = index_path
+        except RuntimeError:
+            self.faiss_index = faiss.read_index(index_path)
+
+        self.faiss_params = meta['faiss_params']
+        self.doc_embeddings_hash_id = np.array(meta['hash_ids'], dtype=object)
+        return True
+
+    def build_faiss(self, fingerprint=None):
+        if fingerprint is None:
+            self.create_faiss()
+        else:
+            if not self.load_faiss(fingerprint):
+                self.create_faiss()
+                self.save_faiss(fingerprint)
+        self.set_search_params()
+
+        # In the case of faiss we can remove the documents matrix
+        del self.doc_embeddings_matrix
+
+    """
+    ==============================================================================
+        LINEAR TRANSFORM (PCA / WHITENING)
+    ==============================================================================
+    """
+    def fit_transform(self, matrix, fingerprint=None):
+        """
+            Learns the PCA projection (optionally whitened) from the raw corpus matrix,
+            mahalanobis is euclidean distance on whitened vectors
+        """
+        self.transform = None
+        if (self.pca_dimensions is None and not self.whiten) or matrix.shape[0] < 2:
+            return
+        if fingerprint is not None and self.load_transform(fingerprint):
+            return
+
+        # Covariance accumulated in float64 chunks, never a centered copy of the whole corpus
+        mean = matrix.mean(axis=0, dtype=np.float64)
+        cov = np.zeros(shape=(matrix.shape[1], matrix.shape[1]), dtype=np.float64)
+        for i in range(0, matrix.shape[0], 65536):
+            chunk = matrix[i:i+65536].astype(np.float64) - mean
+            cov += chunk.T @ chunk
+        cov /= matrix.shape[0] - 1
+
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        order = np.argsort(eigenvalues)[::-1][:self.pca_dimensions]
+        projection = eigenvectors[:, order]
+        if self.whiten:
+            projection /= np.sqrt(np.maximum(eigenvalues[order], 0) + 1e-8)
+
+        self.transform = {
+            'mean': np.float32(mean),
+            'projection': np.ascontiguousarray(projection, dtype=np.float32)
+        }
+        if fingerprint is not None:
+            self.save_transform(fingerprint)
+
+    def apply_transform(self, vectors):
+        if self.transform is None:
+            return vectors
+        return np.ascontiguousarray((vectors - self.transform['mean']) @ self.transform['projection'], dtype=np.float32)
+
+    """
+    ==============================================================================
+        EXACT SEARCH
+    ==============================================================================
+    """
+    def stack_vectors(self, vectors):
+        if len(vectors) == 0:
+            return np.zeros(shape=(0, self.method.NUM_DIMENSIONS), dtype=np.float32)
+        return np.ascontiguousarray(np.stack(vectors, axis=0), dtype=np.float32)
+
+    def prepare_matrix(self, matrix):
+        """
+            matrix: raw float32 vectors, never modified (it may be a read-only memmap)
+            returns the transformed matrix and a per row factor: 1 / norm (cosine), squared norm (euclidean)
+        """
+        matrix = self.apply_transform(matrix)
+        if self.similarity_metric == 'cosine':
+            norms = 1 / (np.sqrt(SearchEngine.row_dot(matrix)) + 1e-30)
+        elif self.similarity_metric in ('euclidean', 'mahalanobis'):
+            norms = SearchEngine.row_dot(matrix)
+        else:
+            norms = None
+        return matrix, norms
+
+    @staticmethod
+    def row_dot(matrix):
+        # Chunked, a memmapped matrix is never loaded whole in private memory
+        output = np.zeros(matrix.shape[0], dtype=np.float32)
+        for i in range(0, matrix.shape[0], 65536):
+            chunk = matrix[i:i+65536]
+            output[i:i+65536] = np.einsum('ij,ij->i', chunk, chunk)
+        return output
+
+    def create_matrix(self, vectors):
+        # One C-contiguous float32 matrix, built once and reused by every query
+        return self.prepare_matrix(self.stack_vectors(vectors))
+
+    def exact_scores(self, vectors, matrix, norms):
+        """
+            vectors: (num_queries, num_dimensions) float32 matrix
+            returns a (num_queries, num_docs) matrix, higher is more similar
+        """
+        if self.similarity_metric == 'cosine':
+            vectors = vectors / (np.linalg.norm(vectors, keepdims=True, axis=-1) + 1e-30)
+            return (vectors @ matrix.T) * norms
+        elif self.similarity_metric == 'inner':
+            return vectors @ matrix.T
+        elif self.similarity_metric in ('euclidean', 'mahalanobis'):
+            # -||x - q||^2 without the ||q||^2 term, it does not change the ranking
+            return 2 * (vectors @ matrix.T) - norms
+        return -distance.cdist(vectors, matrix, self.similarity_metric)
 
-        # In the case of faiss we can remove this documents lists
-        del self.doc_embeddings_vectors
+    @staticmethod
+    def top_k(scores, k):
+        k = min(k, scores.shape[-1])
+        if k <= 0:
+            return np.zeros(shape=(scores.shape[0], 0), dtype=np.int64)
 
-    def __init__(self, method, doc_embeddings, use_faiss=False, similarity_metric='cosine'):
+        # Unordered top-k in O(N), then sort only those k
+        indices = np.argpartition(-scores, k - 1, axis=-1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, indices, axis=-1), axis=-1)
+        return np.take_along_axis(indices, order, axis=-1)
+
+    """
+    ==============================================================================
+        INCREMENTAL UPDATES
+    ==============================================================================
+    """
+    def copy_faiss(self):
+        import faiss
+
+        # Copy on write, running searches keep the current index. Mmapped inverted lists are
+        # read only, the first copy is read from disk in memory (the file of its fingerprint,
+        # deleted once two newer indexes were saved)
+        if self.faiss_index_mmap_path is not None and os.path.isfile(self.faiss_index_mmap_path):
+            index = faiss.read_index(self.faiss_index_mmap_path)
+        else:
+            index = faiss.clone_index(self.faiss_index)
+        self.set_search_params(index)
+        return index
+
+    def swap_faiss(self, index):
+        # Under self.lock
+        self.faiss_index = index
+        self.faiss_index_mmap_path = None
+
+    def rebuild_faiss(self, index, removed_ids):
+        import faiss
+
+        # e.g. HNSW can not remove ids, a new index is built from the stored vectors of the rest
+        ids = faiss.vector_to_array(index.id_map)
+        vectors = index.index.reconstruct_n(0, index.ntotal)
+        keep = ~np.isin(ids, removed_ids)
+
+        rebuilt = faiss.IndexIDMap(faiss.index_factory(self.num_dimensions, self.index_spec.format(num_centroids=self.num_centroids), self.faiss_params['metric']))
+        rebuilt.train(vectors[keep])
+        rebuilt.add_with_ids(vectors[keep], ids[keep])
+        self.set_search_params(rebuilt)
+        return rebuilt
+
+    def add(self, hash_ids, vectors):
+        """
+            hash_ids: list of hash_ids, already indexed ones are replaced
+            vectors: list or matrix of document vectors, same order as hash_ids
+        """
+        if len(hash_ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(hash_ids), -1)
+
+        # Writers one at a time (update_lock), searches only wait for the swap (lock)
+        with self.update_lock:
+            self.remove([hash_id for hash_id in hash_ids if hash_id in self.doc_embeddings_positions])
+            first_position = len(self.doc_embeddings_hash_id)
+            positions = np.arange(first_position, first_position + len(hash_ids), dtype=np.int64)
+
+            if self.use_faiss:
+                index = self.copy_faiss()
+                index.add_with_ids(self.search_preprocess(self.apply_transform(vectors)), positions)
+            else:
+                matrix, norms = self.create_matrix(vectors)
+
+            with self.lock:
+                if self.use_faiss:
+                    self.swap_faiss(index)
+                else:
+                    # New arrays instead of in-place updates, running searches keep their snapshot
+                    self.doc_embeddings_matrix = np.concatenate([self.doc_embeddings_matrix, matrix], axis=0)
+                    if norms is not None:
+                        self.doc_embeddings_norms = np.concatenate([self.doc_embeddings_norms, norms], axis=0)
+                    self.doc_embeddings_alive = np.concatenate([self.doc_embeddings_alive, np.ones(len(hash_ids), dtype=bool)], axis=0)
+
+                self.doc_embeddings_hash_id = np.concatenate([self.doc_embeddings_hash_id, np.array(hash_ids, dtype=object)], axis=0)
+                self.doc_embeddings_positions.update(zip(hash_ids, positions.tolist()))
+                self.version += 1
+
+    def remove(self, hash_ids):
+        """
+            hash_ids: list of hash_ids, unknown ones are ignored
+            Removed documents are tombstoned and compacted in the background
+        """
+        with self.update_lock, self.lock:
+            positions = [self.doc_embeddings_positions.pop(hash_id) for hash_id in hash_ids if hash_id in self.doc_embeddings_positions]
+            if len(positions) == 0:
+                return
+
+            if not self.use_faiss:
+                alive = self.doc_embeddings_alive.copy()
+                alive[positions] = False
+                self.doc_embeddings_alive = alive
+            self.tombstones = self.tombstones | set(positions)
+            self.version += 1
+
+            if not self.is_compacting and len(self.tombstones) > self.compact_ratio * max(1, len(self.doc_embeddings_positions)):
+                self.is_compacting = True
+                Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        try:
+            if self.use_faiss:
+                # The new index is built aside, searches keep the current one until the swap
+                with self.update_lock:
+                    tombstones = np.array(sorted(self.tombstones), dtype=np.int64)
+                    index = self.copy_faiss()
+                    try:
+                        index.remove_ids(tombstones)
+                    except RuntimeError:
+                        index = self.rebuild_faiss(index, tombstones)
+
+                    with self.lock:
+                        self.swap_faiss(index)
+                        hash_ids = self.doc_embeddings_hash_id.copy()
+                        hash_ids[tombstones] = None
+                        self.doc_embeddings_hash_id = hash_ids
+                        self.tombstones = set()
+                        self.version += 1
+                return
+
+            # Build the compacted arrays without the lock, swap them only if nothing changed meanwhile
+            with self.lock:
+                version = self.version
+                matrix, norms, hash_ids, alive = self.doc_embeddings_matrix, self.doc_embeddings_norms, self.doc_embeddings_hash_id, self.doc_embeddings_alive
+
+            matrix = np.ascontiguousarray(matrix[alive])
+            norms = norms[alive] if norms is not None else None
+            hash_ids = hash_ids[alive]
+
+            with self.update_lock, self.lock:
+                if version != self.version:
+                    return
+                self.doc_embeddings_matrix, self.doc_embeddings_norms, self.doc_embeddings_hash_id = matrix, norms, hash_ids
+                self.doc_embeddings_alive = np.ones(len(hash_ids), dtype=bool)
+                self.doc_embeddings_positions = {hash_id: i for i, hash_id in enumerate(hash_ids.tolist())}
+                self.tombstones = set()
+                self.version += 1
+        finally:
+            self.is_compacting = False
+
+    def __init__(self, method, doc_embeddings, use_faiss=False, similarity_metric='cosine', index_path=None,
+            index_spec='IVF{num_centroids},Flat', num_centroids=None, search_params=None, compact_ratio=0.1,
+            section_doc_embeddings=None, name=None, pca_dimensions=None, whiten=False):
+        """
+            section_doc_embeddings: {section: doc_embeddings}, one extra index per section
+            pca_dimensions / whiten: fitted linear transform applied to documents and queries
+        """
         self.method = method
-        self.doc_embeddings_vectors = []
-        self.doc_embeddings_hash_id = []
-        for doc in doc_embeddings:
-            if doc['vector'] is None or np.prod(doc['vector'].shape) == 0:
-                continue
+        self.name = name if name is not None else getattr(method, 'NAME', None)
+        if isinstance(doc_embeddings, tuple):
+            # (hash_ids, matrix) from the embeddings store, the matrix is used as is (memmap)
+            doc_embeddings_hash_id, raw_matrix = doc_embeddings
+        else:
+            doc_embeddings_vectors = []
+            doc_embeddings_hash_id = []
+            for doc in doc_embeddings:
+                if doc['vector'] is None or np.prod(doc['vector'].shape) == 0:
+                    continue
 
-            self.doc_embeddings_vectors.append(doc['vector'])
-            self.doc_embeddings_hash_id.append(doc['hash_id'])
+                doc_embeddings_vectors.append(doc['vector'])
+                doc_embeddings_hash_id.append(doc['hash_id'])
+            raw_matrix = self.stack_vectors(doc_embeddings_vectors)
+            del doc_embeddings_vectors
 
         self.use_faiss = use_faiss
         self.similarity_metric = similarity_metric
+        self.index_path = index_path
+        self.pca_dimensions = pca_dimensions
+        # Mahalanobis distance is the euclidean distance between whitened vectors
+        self.whiten = whiten or similarity_metric == 'mahalanobis'
+        self.doc_embeddings_hash_id = np.array(doc_embeddings_hash_id, dtype=object)
+
+        # Incremental updates, see add / remove
+        self.lock = RLock()
+        self.update_lock = RLock()
+        self.version = 0
+        self.compact_ratio = compact_ratio
+        self.is_compacting = False
+        self.tombstones = set()
+        self.doc_embeddings_alive = np.ones(len(self.doc_embeddings_hash_id), dtype=bool)
+        self.faiss_index_mmap_path = None
+
+        # FAISS index description, see create_faiss
+        num_docs = raw_matrix.shape[0]
+        self.index_spec = index_spec
+        self.num_centroids = num_centroids if num_centroids is not None else max(1, min(int(4 * np.sqrt(num_docs)), num_docs // 39))
+        self.search_params = {'nprobe': 16, 'efSearch': 64} if search_params is None else search_params
+
+        # Trained state (transform, faiss index) is persisted per fingerprint of the raw vectors
+        needs_training = self.use_faiss or self.pca_dimensions is not None or self.whiten
+        fingerprint = self.compute_fingerprint(raw_matrix) if self.index_path is not None and needs_training else None
+        self.fit_transform(raw_matrix, fingerprint)
+        self.doc_embeddings_matrix, self.doc_embeddings_norms = self.prepare_matrix(raw_matrix)
+        self.num_dimensions = self.doc_embeddings_matrix.shape[-1]
+        del raw_matrix
 
         if self.use_faiss:
             print('FAISS INDEXING...', end=' ')
-            self.create_faiss()
+            self.build_faiss(fingerprint)
             print('DONE')
+        self.doc_embeddings_positions = {hash_id: i for i, hash_id in enumerate(self.doc_embeddings_hash_id.tolist())}
+
+        # Section scoped indexes share the configuration of the document one
+        self.section_engines = {}
+        for section, section_embeddings in (section_doc_embeddings or {}).items():
+            self.section_engines[section] = SearchEngine(method, section_embeddings, use_faiss=use_faiss, similarity_metric=similarity_metric,
+                index_path=index_path, index_spec=index_spec, search_params=search_params, compact_ratio=compact_ratio,
+                name='%s.%s' % (self.name, section), pca_dimensions=pca_dimensions, whiten=whiten)
+
+    def get_engine(self, section=None):
+        if section is None:
+            return self
+        return self.section_engines[section]
+
+    def search_vectors(self, vectors, k=10):
+        """
+            vectors: (num_queries, num_dimensions) matrix of query vectors
+            returns a list with the ranked hash_ids of every query
+        """
+        vectors = self.apply_transform(np.ascontiguousarray(vectors, dtype=np.float32))
 
-    def get_similar_docs_than(self, text, k=10):
-        vector = self.method.compute_mean_vector_from_text(text)
-        
         if self.use_faiss:
-            vector = self.search_preprocess(vector)
-            vector = np.expand_dims(vector, axis=0)
+            vectors = self.search_preprocess(vectors)
+
+            # Find similars, asking for extra results to make up for the tombstones
+            with self.lock:
+                index, tombstones, hash_ids = self.faiss_index, self.tombstones, self.doc_embeddings_hash_id
+            _, indices = index.search(vectors, k + len(tombstones))
+            return [[hash_ids[idx] for idx in row if idx >= 0 and idx not in tombstones][:k] for row in indices]
+
+        with self.lock:
+            matrix, norms, hash_ids, alive = self.doc_embeddings_matrix, self.doc_embeddings_norms, self.doc_embeddings_hash_id, self.doc_embeddings_alive
+            has_tombstones = len(self.tombstones) > 0
+
+        scores = self.exact_scores(vectors, matrix, norms)
+        if has_tombstones:
+            scores[:, ~alive] = -np.inf
+        indices = SearchEngine.top_k(scores, k)
+        return [hash_ids[row[np.isfinite(scores[i, row])]].tolist() for i, row in enumerate(indices)]
+
+    def rerank_vector(self, vector, hash_ids, k=10):
+        """
+            Exact scores restricted to hash_ids (e.g. lexical candidates), exact mode only
+        """
+        assert(not self.use_faiss)
+        with self.lock:
+            rows = np.array([self.doc_embeddings_positions[hash_id] for hash_id in hash_ids if hash_id in self.doc_embeddings_positions], dtype=np.int64)
+            matrix, norms, all_hash_ids = self.doc_embeddings_matrix, self.doc_embeddings_norms, self.doc_embeddings_hash_id
 
-            # Find similars
-            _, indices = self.faiss_index.search(vector, k)
-            docs_hash_id = [self.doc_embeddings_hash_id[idx] for idx in indices[0]]
+        vectors = self.apply_transform(np.ascontiguousarray(np.expand_dims(vector, axis=0), dtype=np.float32))
+        scores = self.exact_scores(vectors, matrix[rows], norms[rows] if norms is not None else None)
+        return all_hash_ids[rows[SearchEngine.top_k(scores, k)[0]]].tolist()
+
+    def get_similar_docs_than(self, text, k=10, section=None):
+        vector = self.method.compute_mean_vector_from_text(text)
+        if vector is None:
+            return []
+
+        return self.get_engine(section).search_vectors(np.expand_dims(vector, axis=0), k=k)[0]
+
+    def search_batch(self, texts, k=10, section=None):
+        if hasattr(self.method, 'compute_mean_vectors_from_texts'):
+            vectors = self.method.compute_mean_vectors_from_texts(texts)
         else:
-            distances = distance.cdist(np.expand_dims(vector, axis=0), np.stack(self.doc_embeddings_vectors, axis=0), self.translate_distance_to_pdist(self.similarity_metric))
-            indices = distances.argsort(axis=-1)[:, :k]
-            docs_hash_id = [self.doc_embeddings_hash_id[idx] for idx in indices[0]]
-        return docs_hash_id
\ No newline at end of file
+            vectors = [self.method.compute_mean_vector_from_text(text) for text in texts]
+
+        # Queries that could not be embedded get an empty result
+        valid = [i for i, vector in enumerate(vectors) if vector is not None]
+        results = [[] for _ in texts]
+        if len(valid) > 0:
+            for i, docs_hash_id in zip(valid, self.get_engine(section).search_vectors(np.stack([vectors[i] for i in valid], axis=0), k=k)):
+                results[i] = docs_hash_id
+        return results
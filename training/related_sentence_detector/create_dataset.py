@@ -55,7 +55,7 @@ for list_candidates in tqdm(poss_sections.values(), desc='Embedding search terms
 
 dataset = []
 print('Retrieving documents from database...')
-documents = Database.list_raw_documents()
+documents = Database.iter_raw_documents()
 
 def create_emb(doc):
     batch_size = 60
@@ -42,7 +42,8 @@ for list_candidates in poss_sections.values():
         sentence.clear_embeddings()
 
 dataset = []
-documents = Database.list_raw_documents()
+num_documents = Database.count_documents()
+documents = Database.iter_raw_documents()
 for i, doc in enumerate(documents):
     for section_title, section_text in doc['raw']['sections'].items():
         if section_title == "" or section_title.isnumeric():
@@ -72,7 +73,7 @@ for i, doc in enumerate(documents):
                 'match': max_section
             })
     
-    print(i, len(documents))
+    print(i, num_documents)
 
 os.makedirs(os.path.join(data_path), exist_ok=True)
 with open(os.path.join(data_path, 'classification_dataset.pickle'), 'wb') as f: